@@ -0,0 +1,159 @@
+"""Бенчмарк горячих путей бота на синтетических расписаниях.
+
+Запуск:
+    python benchmark.py --sizes 100 1000 10000 100000 --output bench.json
+
+Для каждого размера создаётся временный каталог с users.json на N учеников,
+после чего через поддельный Bot прогоняются построение очереди напоминаний,
+пиковый тик, очистка журнала отправленных, update_user_data, сохранение
+правок расписания и холодный старт из JSON и из снимка состояния. Результат —
+JSON, который удобно сравнивать между версиями.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import napominanie as bot
+
+SLOTS = ["08:00", "09:00", "10:00", "11:30", "14:00", "15:00", "17:00", "18:30", "19:00", "19:30"]
+
+
+class FakeBot:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sent = 0
+
+    async def send_message(self, chat_id, text):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+
+
+class FakeApp:
+    def __init__(self, fake_bot):
+        self.bot = fake_bot
+
+
+def generate_roster(size, seed=0):
+    rnd = random.Random(seed)
+    roster = {}
+    for i in range(size):
+        lessons = [
+            {"day": rnd.choice(bot.DAYS), "time": rnd.choice(SLOTS), "description": "Английский"}
+            for _ in range(rnd.randint(1, 4))
+        ]
+        roster[f"student{i}"] = {"name": f"Ученик {i}", "schedule": lessons}
+    return roster
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+async def timed_async(coro):
+    start = time.perf_counter()
+    result = await coro
+    return time.perf_counter() - start, result
+
+
+async def run_size(size, send_latency):
+    result = {"students": size}
+    with open(bot.SCHEDULE_FILE, "w", encoding="utf-8") as f:
+        json.dump(generate_roster(size), f, ensure_ascii=False)
+
+    result["load_s"], _ = timed(bot.load_default_schedule)
+    result["lessons"] = sum(len(l) for l in bot.compiled_schedule.values())
+    bot.user_data = {user: 1000 + i for i, user in enumerate(bot.temporary_schedule)}
+    bot.open_sent_store(os.path.join(os.getcwd(), "sent.db"))
+    result["update_user_data_s"], _ = await timed_async(bot.update_user_data())
+
+    tracemalloc.start()
+    result["rebuild_reminders_s"], _ = timed(bot.rebuild_reminders)
+    result["heap_entries"] = len(bot.reminder_heap)
+
+    # Пиковый тик: момент, на который приходится больше всего напоминаний
+    counts = {}
+    for entry in bot.reminder_heap:
+        counts[entry[0]] = counts.get(entry[0], 0) + 1
+    peak_at = max(counts, key=counts.get)
+    heap_before = len(bot.reminder_heap)
+
+    fake_bot = FakeBot(send_latency)
+    bot.rate_limiter = bot.RateLimiter(rate=10 ** 9, per_chat_interval=0)
+    bot.broadcaster = bot.Broadcaster(fake_bot)
+    result["peak_due"] = counts[peak_at]
+    result["peak_tick_s"], _ = await timed_async(bot.fire_due_reminders(FakeApp(fake_bot), peak_at))
+    result["drain_s"], _ = await timed_async(bot.broadcaster.stop(timeout=600))
+    result["sends"] = fake_bot.sent
+    result["sends_per_s"] = fake_bot.sent / (result["peak_tick_s"] + result["drain_s"])
+
+    # Обычный тик, когда ничего не подошло
+    idle_at = bot.reminder_heap[0][0] - 1
+    result["idle_tick_s"], _ = await timed_async(bot.fire_due_reminders(FakeApp(fake_bot), idle_at))
+    result["heap_growth"] = len(bot.reminder_heap) - heap_before
+    _, result["peak_memory_bytes"] = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result["clean_sent_reminders_s"], _ = await timed_async(bot.clean_sent_reminders())
+
+    user = next(iter(bot.temporary_schedule))
+    lesson = {"day": "Среда", "time": "12:00", "description": "Бенчмарк"}
+    result["edit_commit_s"], _ = timed(bot.commit_schedule_change, {"op": "add", "user": user, "lesson": lesson})
+    result["snapshot_write_s"], _ = timed(bot.write_schedule_snapshot, bot.copy_schedule(), bot.journal_seq)
+    if bot.compaction_task:
+        await bot.compaction_task
+
+    # Холодный старт: разбор users.json против снимка состояния
+    if os.path.exists(bot.JOURNAL_FILE):
+        os.remove(bot.JOURNAL_FILE)
+    result["state_cache_write_s"], _ = timed(bot.save_state_cache)
+    result["cold_start_json_s"], _ = timed(bot.load_default_schedule)
+    result["cold_start_cache_s"], _ = timed(lambda: bot.load_default_schedule(bot.read_state_cache()))
+    bot.sent_db.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--send-latency", type=float, default=0.0, help="задержка поддельного send_message, с")
+    parser.add_argument("--output", help="куда записать JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    report = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "results": [],
+    }
+    cwd = os.getcwd()
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                # Служебный вывод бота уводим в stderr, чтобы не смешивать с JSON
+                with contextlib.redirect_stdout(sys.stderr):
+                    report["results"].append(asyncio.run(run_size(size, args.send_latency)))
+            finally:
+                os.chdir(cwd)
+        print(f"[INFO] {size} учеников готово", file=sys.stderr)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
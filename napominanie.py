@@ -1,171 +1,1605 @@
+import time
+STARTED_AT = time.monotonic()  # отсчёт времени до первого напоминания, включая импорты
+
 import os
 import json
-import requests
 from datetime import datetime, timedelta
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from dotenv import load_dotenv
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
-import pytz
+from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, ContextTypes, filters
 import logging
 import asyncio
+import functools
+import heapq
+import itertools
+import marshal
+import mmap
+import signal
+import socket
+import zlib
+import contextlib
+import sqlite3
+import tempfile
+import types
 from telegram.error import NetworkError, RetryAfter, TimedOut
 
 load_dotenv()
-admin_edit_mode = False  # режим ожидания ввода JSON-расписания
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
-GITHUB_RAW_URL = "https://raw.githubusercontent.com/Ruslan-16/ScheduleLessons1Bot/main/users.json"
+SYNC_URL = os.getenv("SYNC_URL", "")  # откуда подтягивать расписание (users.json); пусто — не опрашивать
+SYNC_INTERVAL = int(os.getenv("SYNC_INTERVAL", "300"))  # секунды между запросами к SYNC_URL
+WATCH_INTERVAL = int(os.getenv("WATCH_INTERVAL", "5"))  # секунды между проверками mtime users.json; 0 — не следить
 
 logging.basicConfig(level=logging.INFO)
-logging.getLogger('apscheduler').setLevel(logging.DEBUG)
-
-temporary_schedule = {}
+logging.getLogger('apscheduler').setLevel(os.getenv("SCHEDULER_LOG_LEVEL", "INFO"))
+
+temporary_schedule = {}  # базовое расписание; разовые правки лежат поверх него в schedule_overlay
+schedule_overlay = {}  # дата ISO -> ученик -> {"cancel": [минуты дня], "add": [разовые уроки]}
+compiled_schedule = {}  # ученик -> кортеж Lesson
+lesson_index = {}  # ученик -> {(день недели, минута): позиция урока в schedule}
+slot_index = {}  # (день недели, минута) -> ученики, у которых в это время урок
+user_tz = {}  # ученик -> имя пояса, в котором записаны его уроки
 user_data = {}
-sent_reminders_24h = set()
-sent_reminders_1h = set()
-local_tz = pytz.timezone('Europe/Moscow')
+chat_members_cache = None  # chat_id -> ученики с этим чатом; None — собрать заново из user_data
+sent_reminders = set()  # (id ученика, минута эпохи занятия, тип)
+sent_user_ids = {}  # ученик -> компактный числовой id
+sent_db = None
+cluster_workers = []  # живые воркеры кластера, отсортированные по id
+cluster_chats_version = 0  # до какой версии таблицы chats мы уже дочитали
+cluster_poller = False  # держит ли этот воркер аренду на getUpdates
+journal_seq = 0  # номер последней применённой правки
+journal_records = 0  # правок в журнале с момента последнего снимка
+compaction_task = None
+schedule_version = 0  # растёт при каждом изменении расписания
+schedule_file_mtime = None  # mtime users.json, который мы уже видели
+sync_etag = None
+sync_last_modified = None
+render_cache = {}  # (что, ученик) -> (версия, дата, страницы)
+current_snapshot = None  # (версия, неизменяемый снимок temporary_schedule)
+current_zones = None  # (версия, пояса, в которых записаны уроки учеников)
+student_locks = {}  # ученик -> asyncio.Lock для писателей его расписания
+chat_locks = {}  # chat_id -> asyncio.Lock: апдейты одного чата идут по очереди
+user_data_dirty = False
+user_data_flush_task = None
+user_data_write = None  # запись user_data, идущая сейчас в пуле потоков
+state_cache_dirty = False
+state_cache_task = None
+state_cache_write = None  # запись снимка состояния, идущая сейчас в пуле потоков
+DEFAULT_TZ = os.getenv("DEFAULT_TZ", "Europe/Moscow")  # пояс бота и учеников без поля tz
+local_tz = ZoneInfo(DEFAULT_TZ)
+
+DAYS = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+DAY_INDEX = {day: i for i, day in enumerate(DAYS)}
+LESSON_MINUTES = 60  # длительность урока для поиска накладок
+REMINDER_OFFSETS = {"24h": 24 * 3600, "1h": 3600}  # секунды до занятия
+REMINDER_GRACE = 15 * 60  # на сколько секунд напоминание может опоздать
+DIGEST_WINDOW = int(os.getenv("DIGEST_WINDOW", "300"))  # секунды: почти одновременные напоминания в один чат уходят одним сообщением
+DIGEST_BY_DAY = os.getenv("DIGEST_BY_DAY", "1") == "1"  # напоминания за день о занятиях одного дня в чате — одним сообщением
+OCCURRENCE_WEEKS = 2  # на сколько недель вперёд строится таблица UTC-моментов слота
+REMINDER_KINDS = {"24h": 0, "1h": 1}
+SENT_DB = os.getenv("SENT_DB", "sent_reminders.db")
+CLUSTER_DB = os.getenv("CLUSTER_DB", "")  # общий SQLite-файл кластера; пусто — один процесс
+CLUSTER_HEARTBEAT = int(os.getenv("CLUSTER_HEARTBEAT", "10"))  # секунды между продлениями аренды
+CLUSTER_LEASE = int(os.getenv("CLUSTER_LEASE", "30"))  # через сколько секунд молчащий воркер считается мёртвым
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+SCHEDULE_FILE = "users.json"
+JOURNAL_FILE = "users.journal"
+JOURNAL_COMPACT_EVERY = 200  # после скольких правок переписывать снимок
+USER_DATA_FILE = "user_data.json"
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))  # сколько апдейтов обрабатывать одновременно
+REMINDER_TICK_BATCH = 500  # после стольких записей тик напоминаний уступает event loop обработчикам
+USER_DATA_FLUSH_DELAY = int(os.getenv("USER_DATA_FLUSH_MS", "500")) / 1000
+STATE_CACHE = os.getenv("STATE_CACHE", "state.cache")  # бинарный снимок состояния для быстрого старта; пусто — не писать
+STATE_CACHE_FORMAT = 3  # менять при изменении состава снимка
+STATE_CACHE_DELAY = 5  # секунды, на которые откладывается запись снимка после правок
+
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "8"))
+SEND_RATE = 30  # сообщений в секунду — лимит Telegram для массовой рассылки
+PER_CHAT_INTERVAL = 1.0  # не чаще одного сообщения в секунду в один чат
+SEND_MAX_ATTEMPTS = 5
+SEND_BACKOFF_BASE = 1
+SEND_BACKOFF_CAP = 60
+OUTBOX_RETRY_DELAY = 60  # секунды до новой попытки, если Telegram недоступен
+OUTBOX_DEAD_TTL = 7 * 24 * 3600  # сколько хранить в outbox окончательно недоставленное
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # 0 — не поднимать эндпоинт
+MESSAGE_LIMIT = 4096  # максимальная длина сообщения Telegram
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 408: "Request Timeout",
+                413: "Payload Too Large", 503: "Service Unavailable"}
+HTTP_READ_TIMEOUT = 10  # секунды на заголовки и тело запроса
+HTTP_MAX_HEADERS = 100
+HTTP_MAX_BODY = 256 * 1024  # update от Telegram занимает единицы килобайт
+HTTP_SHUTDOWN_TIMEOUT = 15  # сколько при остановке ждать уже открытые соединения
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling, webhook или worker (только напоминания, без приёма обновлений)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес, который сообщаем Telegram
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # пусто — сгенерировать при регистрации webhook (нужен WEBHOOK_URL)
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "5000"))
+
+broadcaster = None
+reminder_heap = []  # (секунды эпохи отправки, seq, ученик, поколение, тип, секунды эпохи занятия, урок)
+reminder_generation = {}  # ученик -> поколение его расписания
+reminders_sent_ahead = set()  # (ученик, момент занятия, тип), ушедшие раньше срока в составе дайджеста
+reminder_observer = None  # необязательный обработчик observer(событие, ученик, тип, момент занятия, now) — для симуляции
+reminder_wakeup = None
+_reminder_seq = itertools.count()
+
+class Metrics:
+    """Счётчики и гистограммы в памяти процесса, отдаются в формате Prometheus."""
+
+    BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 60, 300)
+
+    def __init__(self):
+        self.counters = {}  # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> [счётчики по корзинам, сумма, количество]
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                hist[0][i] += 1
+        hist[1] += value
+        hist[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = [f'{k}="{v}"' for k, v in (*labels, *extra)]
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self):
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+            for bound, bucket in zip(self.BUCKETS, buckets):
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {bucket}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        lines = [f"{name} {dict(labels)}: {value}" for (name, labels), value in sorted(self.counters.items())]
+        for (name, labels), (_, total, count) in sorted(self.histograms.items()):
+            lines.append(f"{name} {dict(labels)}: n={count}, avg={total / count * 1000:.1f} мс")
+        return "\n".join(lines) or "Метрик пока нет."
+
+metrics = Metrics()
+
+class Clock:
+    """Источник текущего времени для расписания и напоминаний; симуляция подменяет его виртуальным."""
+
+    def time(self):
+        return time.time()
+
+    def now(self, tz=None):
+        return datetime.now(tz or local_tz)
+
+clock = Clock()
+
+def load_default_schedule(state=None):
+    """Загружает расписание из снимка состояния, если он свежий, иначе из users.json."""
+    global temporary_schedule, journal_seq, journal_records, schedule_file_mtime, state_cache_dirty
+    try:
+        mtime = os.stat(SCHEDULE_FILE).st_mtime_ns
+    except OSError:
+        mtime = None
+    # В user_tz учеников без поля tz записан DEFAULT_TZ — с другим поясом снимок не годится
+    cached = state is not None and state["schedule_mtime"] == mtime and state["default_tz"] == DEFAULT_TZ
+    if cached:
+        # Уроки уже разобраны и проиндексированы — остаётся собрать объекты Lesson
+        schedule_file_mtime = mtime
+        temporary_schedule = state["schedule"]
+        journal_seq = state["journal_seq"]
+        schedule_overlay.clear()
+        schedule_overlay.update(state["overlay"])
+        compiled_schedule.clear()
+        compiled_schedule.update({
+            u: tuple(Lesson(*fields) for fields in lessons) for u, lessons in state["compiled"].items()
+        })
+        user_tz.clear()
+        user_tz.update(state["user_tz"])
+        lesson_index.clear()
+        lesson_index.update(state["lesson_index"])
+        slot_index.clear()
+        slot_index.update(state["slot_index"])
+    else:
+        try:
+            with open(SCHEDULE_FILE, "r", encoding="utf-8") as f:
+                schedule_file_mtime = os.fstat(f.fileno()).st_mtime_ns
+                data = json.load(f)
+                temporary_schedule = {u: d for u, d in data.items() if 'schedule' in d}
+                journal_seq = data.get("_journal", {}).get("seq", 0)
+                schedule_overlay.clear()
+                schedule_overlay.update(data.get("_overlay", {}))
+        except Exception as e:
+            print(f"[ERROR] Не удалось загрузить расписание: {e}")
+            temporary_schedule = {}
+            journal_seq = 0
+            schedule_overlay.clear()
+        compiled_schedule.clear()
+        user_tz.clear()
+        lesson_index.clear()
+        slot_index.clear()
+        state_cache_dirty = True
+
+    # Доигрываем правки, которые не успели попасть в снимок
+    replayed = 0
+    users = set()
+    for path in (JOURNAL_FILE + ".old", JOURNAL_FILE):
+        for record in read_journal(path):
+            if record["seq"] <= journal_seq:
+                continue
+            if CLUSTER_DB and record["seq"] != journal_seq + 1:
+                # Лидер поглотил пропущенные правки снимком, который мы прочитать не успели;
+                # остальное доиграет catch_up_journal после нового снимка
+                break
+            apply_schedule_change(record)
+            users.update(changed_users(record))
+            journal_seq = record["seq"]
+            replayed += 1
+    if os.path.exists(JOURNAL_FILE) or os.path.exists(JOURNAL_FILE + ".old"):
+        print(f"[INFO] Из журнала восстановлено правок: {replayed}")
+        if CLUSTER_DB:
+            # Общий журнал читают и другие воркеры — снимок переписывает только лидер
+            journal_records = replayed
+        else:
+            write_schedule_snapshot(copy_schedule(), journal_seq)
+            if os.path.exists(JOURNAL_FILE):
+                os.remove(JOURNAL_FILE)
+        state_cache_dirty = True
+    prune_overlay()
+    if cached:
+        for user_name in users:
+            compile_user(user_name)
+        print(f"[INFO] Расписание загружено из {STATE_CACHE}")
+    else:
+        compile_schedule()
+    bump_schedule_version()
 
-def load_default_schedule():
-    global temporary_schedule
+def read_journal(path):
     try:
-        with open("users.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
-            temporary_schedule = {u: d for u, d in data.items() if 'schedule' in d}
-    except Exception as e:
-        print(f"[ERROR] Не удалось загрузить расписание: {e}")
-        temporary_schedule = {}
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return []
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            # Обрывок последней строки после падения посреди записи
+            print(f"[WARN] Пропущена повреждённая запись журнала {path}")
+    return records
+
+def write_json_atomic(path, data):
+    write_bytes_atomic(path, json.dumps(data, ensure_ascii=False, indent=4).encode("utf-8"))
+
+def write_bytes_atomic(path, payload):
+    # Имя временного файла уникально и между потоками: фоновая запись может ещё идти,
+    # когда при остановке сохраняем тот же файл
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(path) or ".")
+    try:
+        with metrics.timer("persist_seconds", file=path):
+            with os.fdopen(fd, "wb") as f:
+                try:
+                    # mkstemp создаёт файл с правами 0600 — сохраняем права прежнего файла
+                    os.fchmod(f.fileno(), os.stat(path).st_mode & 0o7777)
+                except FileNotFoundError:
+                    os.fchmod(f.fileno(), 0o644)
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+def copy_schedule():
+    # Уроки и записи оверлея никогда не меняются на месте, поэтому достаточно скопировать контейнеры
+    snapshot = {u: {**d, "schedule": list(d["schedule"])} for u, d in temporary_schedule.items()}
+    snapshot["_overlay"] = {date_iso: dict(users) for date_iso, users in schedule_overlay.items()}
+    return snapshot
+
+def write_schedule_snapshot(snapshot, seq):
+    """Атомарно записывает снимок расписания и убирает поглощённый им журнал."""
+    global schedule_file_mtime
+    write_json_atomic(SCHEDULE_FILE, {**snapshot, "_journal": {"seq": seq}})
+    schedule_file_mtime = os.stat(SCHEDULE_FILE).st_mtime_ns
+    if os.path.exists(JOURNAL_FILE + ".old"):
+        os.remove(JOURNAL_FILE + ".old")
+
+def changed_users(record):
+    return list(record["users"]) if record["op"] in ("replace", "sync") else [record["user"]]
+
+def apply_schedule_change(record, schedule=None):
+    """Применяет запись журнала к расписанию (по умолчанию — к temporary_schedule)."""
+    if schedule is None:
+        schedule = temporary_schedule
+    if "date" in record:
+        # Разовая правка живёт только в оверлее, в чужие копии базы её не переносим
+        if schedule is temporary_schedule:
+            apply_overlay_change(record)
+        return
+    if record["op"] == "sync":
+        # Внешний источник: ученик целиком заменяется или удаляется (None)
+        for user_name, data in record["users"].items():
+            if data is None:
+                schedule.pop(user_name, None)
+            else:
+                schedule[user_name] = {**data, "schedule": list(data["schedule"])}
+        return
+    # Словари учеников не меняются на месте — снимки читателей остаются целыми
+    if record["op"] == "replace":
+        for user_name, lessons in record["users"].items():
+            if user_name in schedule:
+                schedule[user_name] = {**schedule[user_name], "schedule": list(lessons)}
+        return
+    user_name = record["user"]
+    data = schedule.get(user_name)
+    if data is None:
+        return
+    lessons = data["schedule"]
+    if record["op"] == "add":
+        schedule[user_name] = {**data, "schedule": lessons + [record["lesson"]]}
+    elif record["op"] == "move":
+        slot = parse_slot(record["day"], record["time"])
+        if schedule is temporary_schedule:
+            i = find_lesson(user_name, slot)
+        else:
+            i = next((i for i, l in enumerate(lessons) if lesson_slot(l) == slot), None)
+        if i is not None:
+            l = lessons[i]
+            schedule[user_name] = {
+                **data, "schedule": lessons[:i] + [{**l, "day": record["new_day"], "time": record["new_time"]}] + lessons[i + 1:]
+            }
+    elif record["op"] == "delete":
+        slot = parse_slot(record["day"], record["time"])
+        schedule[user_name] = {**data, "schedule": [l for l in lessons if lesson_slot(l) != slot]}
+
+def schedule_snapshot():
+    """Неизменяемый снимок расписания текущей версии для читателей.
+
+    Писатели заменяют словари учеников целиком, поэтому поверхностной копии
+    достаточно, и делается она не чаще одного раза на версию.
+    """
+    global current_snapshot
+    if current_snapshot is None or current_snapshot[0] != schedule_version:
+        current_snapshot = (schedule_version, types.MappingProxyType(dict(temporary_schedule)))
+    return current_snapshot[1]
+
+@contextlib.asynccontextmanager
+async def locked_students(*user_names):
+    """Сериализует писателей расписания одних и тех же учеников.
+
+    Замки берутся в порядке имён, чтобы массовые правки не блокировали друг друга.
+    """
+    async with contextlib.AsyncExitStack() as stack:
+        for user_name in sorted(set(user_names)):
+            await stack.enter_async_context(student_locks.setdefault(user_name, asyncio.Lock()))
+        yield
+
+def per_chat(handler):
+    """Апдейты одного чата обрабатываются по очереди, разных чатов — параллельно."""
+    @functools.wraps(handler)
+    async def run(update, context):
+        chat = update.effective_chat
+        async with chat_locks.setdefault(chat.id if chat else None, asyncio.Lock()):
+            return await handler(update, context)
+    return run
+
+@contextlib.contextmanager
+def journal_lock():
+    """Межпроцессная блокировка журнала; нужна только в режиме кластера."""
+    if not CLUSTER_DB:
+        yield
+        return
+    import fcntl
+    with open(JOURNAL_FILE + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-def load_user_data():
-    global user_data
+def read_schedule_file():
+    try:
+        with open(SCHEDULE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        # Файл могут дописывать прямо сейчас — попробуем на следующей проверке
+        print(f"[WARN] users.json изменён, но не читается: {e}")
+        return None
+
+def snapshot_seq(data):
+    journal = data.get("_journal") if isinstance(data, dict) else None
+    return journal.get("seq", 0) if isinstance(journal, dict) else 0
+
+def reload_schedule_snapshot(data):
+    """Заменяет расписание в памяти снимком users.json; возвращает учеников, которых это коснулось."""
+    global temporary_schedule, journal_seq
+    schedule = {u: d for u, d in data.items() if isinstance(d, dict) and 'schedule' in d}
+    overlay = data.get("_overlay", {})
+    users = {u for u in schedule.keys() | temporary_schedule.keys() if schedule.get(u) != temporary_schedule.get(u)}
+    for entries in (*schedule_overlay.values(), *overlay.values()):
+        users.update(entries)
+    temporary_schedule = schedule
+    schedule_overlay.clear()
+    schedule_overlay.update(overlay)
+    journal_seq = snapshot_seq(data)
+    print(f"[INFO] Расписание перечитано из снимка {SCHEDULE_FILE} (правка {journal_seq})")
+    return users
+
+def catch_up_journal():
+    """Применяет правки, которые другие воркеры дописали в общий журнал.
+
+    Правки, которые лидер уже поглотил снимком и убрал вместе со старым
+    журналом, берутся из users.json: если снимок новее нашей последней
+    правки, сначала перечитываем его.
+    """
+    global journal_seq, journal_records, schedule_file_mtime
+    # Журнал читаем раньше снимка: старый журнал удаляется только после записи нового снимка
+    records = sorted(
+        (r for path in (JOURNAL_FILE + ".old", JOURNAL_FILE) for r in read_journal(path) if r["seq"] > journal_seq),
+        key=lambda r: r["seq"],
+    )
+    users = set()
+    mtime = file_mtime(SCHEDULE_FILE)
+    if mtime != schedule_file_mtime:
+        data = read_schedule_file()
+        if data is not None:
+            schedule_file_mtime = mtime
+            if snapshot_seq(data) > journal_seq:
+                users.update(reload_schedule_snapshot(data))
+    applied = 0
+    for record in records:
+        if record["seq"] <= journal_seq:
+            continue
+        if record["seq"] != journal_seq + 1:
+            print(f"[WARN] В журнале нет правок {journal_seq + 1}–{record['seq'] - 1}, ждём новый снимок")
+            break
+        apply_schedule_change(record)
+        users.update(changed_users(record))
+        journal_seq = record["seq"]
+        journal_records += 1
+        applied += 1
+    if not users:
+        return
+    for user_name in users:
+        compile_user(user_name)
+        schedule_user_reminders(user_name)
+    bump_schedule_version()
+    mark_state_dirty()
+    if applied:
+        print(f"[INFO] Подтянуто правок других воркеров: {applied}")
+
+def append_journal(record):
+    global journal_seq, journal_records
+    journal_seq += 1
+    record["seq"] = journal_seq
+    with metrics.timer("persist_seconds", file=JOURNAL_FILE):
+        with open(JOURNAL_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+    journal_records += 1
+
+def commit_schedule_change(record):
+    """Применяет правку расписания, дописывает её в журнал и обновляет напоминания."""
+    with journal_lock():
+        if CLUSTER_DB:
+            # Сначала чужие правки, чтобы порядок применения совпал с порядком в журнале
+            catch_up_journal()
+        apply_schedule_change(record)
+        users = changed_users(record)
+        for user_name in users:
+            compile_user(user_name)
+        bump_schedule_version()
+        append_journal(record)
+    for user_name in users:
+        schedule_user_reminders(user_name)
+    mark_state_dirty()
+    if journal_records >= JOURNAL_COMPACT_EVERY and is_leader():
+        compact_journal()
+
+def compact_journal():
+    global compaction_task, journal_records
+    if compaction_task and not compaction_task.done():
+        return
+    # Новые правки пишутся в свежий журнал, пока снимок сохраняется в фоне
+    with journal_lock():
+        if os.path.exists(JOURNAL_FILE) and not os.path.exists(JOURNAL_FILE + ".old"):
+            os.replace(JOURNAL_FILE, JOURNAL_FILE + ".old")
+    journal_records = 0
+    loop = asyncio.get_running_loop()
+    compaction_task = loop.run_in_executor(None, write_schedule_snapshot, copy_schedule(), journal_seq)
+
+def load_user_data(state=None):
+    global user_data, chat_members_cache
+    chat_members_cache = None
+    if state is not None and state["user_data_mtime"] == file_mtime(USER_DATA_FILE):
+        user_data = state["user_data"]
+        return
     try:
-        with open("user_data.json", "r", encoding="utf-8") as f:
+        with open(USER_DATA_FILE, "r", encoding="utf-8") as f:
             user_data = json.load(f)
     except FileNotFoundError:
         user_data = {}
 
 def save_user_data():
-    with open("user_data.json", "w", encoding="utf-8") as f:
-        json.dump(user_data, f, ensure_ascii=False, indent=4)
+    global user_data_dirty
+    user_data_dirty = False
+    write_json_atomic(USER_DATA_FILE, dict(user_data))
 
-def clean_sent_reminders():
-    now = datetime.now(local_tz)
-    global sent_reminders_24h, sent_reminders_1h
-
-    def parse_with_tz(dt_str):
-        dt = datetime.fromisoformat(dt_str)
-        return dt if dt.tzinfo else local_tz.localize(dt)
-
-    sent_reminders_24h = {
-        k for k in sent_reminders_24h if parse_with_tz(k[1]) > now
-    }
-    sent_reminders_1h = {
-        k for k in sent_reminders_1h if parse_with_tz(k[1]) > now
+def set_chat_id(user_name, chat_id):
+    global chat_members_cache
+    if user_data.get(user_name) == chat_id:
+        return
+    user_data[user_name] = chat_id
+    chat_members_cache = None
+    mark_user_data_dirty()
+    mark_state_dirty()
+    if CLUSTER_DB:
+        # Остальные воркеры узнают chat_id из общей базы при следующем heartbeat
+        sent_db.execute(
+            "INSERT INTO chats (user, chat_id, version) VALUES (?, ?, (SELECT COALESCE(MAX(version), 0) + 1 FROM chats)) "
+            "ON CONFLICT(user) DO UPDATE SET chat_id = excluded.chat_id, version = excluded.version",
+            (user_name, chat_id),
+        )
+
+def chat_members(chat_id):
+    """Ученики, чьи напоминания приходят в этот чат (например, дети одного родителя)."""
+    global chat_members_cache
+    if chat_members_cache is None:
+        chat_members_cache = {}
+        for user_name, chat in user_data.items():
+            if chat:
+                chat_members_cache.setdefault(chat, []).append(user_name)
+    # Удалённые из user_data отсеиваются здесь, поэтому кэш сбрасывается только при новых chat_id
+    return [u for u in chat_members_cache.get(chat_id, ()) if user_data.get(u) == chat_id]
+
+def mark_user_data_dirty():
+    """Откладывает запись user_data: пачка нажатий «Старт» сохраняется одним файлом."""
+    global user_data_dirty, user_data_flush_task
+    user_data_dirty = True
+    if user_data_flush_task is None or user_data_flush_task.done():
+        user_data_flush_task = asyncio.get_running_loop().create_task(flush_user_data_later())
+
+async def flush_user_data_later():
+    global user_data_dirty, user_data_write
+    loop = asyncio.get_running_loop()
+    while user_data_dirty:
+        await asyncio.sleep(USER_DATA_FLUSH_DELAY)
+        user_data_dirty = False
+        try:
+            # Отмена задачи не останавливает поток — on_shutdown дождётся user_data_write
+            user_data_write = loop.run_in_executor(None, write_json_atomic, USER_DATA_FILE, dict(user_data))
+            await asyncio.shield(user_data_write)
+        except Exception as e:
+            user_data_dirty = True
+            print(f"[ERROR] Не удалось сохранить user_data: {e}")
+
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def read_state_cache():
+    """Читает бинарный снимок состояния через mmap. None — если его нет или он чужого формата."""
+    if not STATE_CACHE:
+        return None
+    try:
+        with open(STATE_CACHE, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            state = marshal.loads(mm)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, EOFError, TypeError) as e:
+        print(f"[WARN] Снимок состояния {STATE_CACHE} не читается, загружаемся из JSON: {e}")
+        return None
+    if not isinstance(state, dict) or state.get("format") != (STATE_CACHE_FORMAT, marshal.version):
+        return None
+    return state
+
+def dump_state_cache():
+    """Сериализует разобранное состояние; вызывается в event loop, пока его никто не меняет.
+
+    Устаревшие части снимка безопасны: расписание сверяется с mtime users.json и
+    доигрывается из журнала, user_data — с mtime своего файла, а журнал
+    отправленных всё равно проверяет SQLite.
+    """
+    return marshal.dumps({
+        "format": (STATE_CACHE_FORMAT, marshal.version),
+        "schedule_mtime": schedule_file_mtime,
+        "default_tz": DEFAULT_TZ,
+        "journal_seq": journal_seq,
+        "schedule": temporary_schedule,
+        "overlay": schedule_overlay,
+        "compiled": {
+            u: tuple((l.weekday, l.minute, l.description) for l in lessons) for u, lessons in compiled_schedule.items()
+        },
+        "user_tz": user_tz,
+        "lesson_index": lesson_index,
+        "slot_index": slot_index,
+        "user_data_mtime": file_mtime(USER_DATA_FILE),
+        "user_data": user_data,
+        "sent_db": os.path.abspath(CLUSTER_DB or SENT_DB),
+        "sent_user_ids": sent_user_ids,
+        "sent": sent_reminders,
+    })
+
+def save_state_cache():
+    global state_cache_dirty
+    state_cache_dirty = False
+    if STATE_CACHE:
+        write_bytes_atomic(STATE_CACHE, dump_state_cache())
+
+def mark_state_dirty():
+    """Откладывает перезапись снимка состояния, чтобы пачка правок дала одну запись."""
+    global state_cache_dirty, state_cache_task
+    state_cache_dirty = True
+    if STATE_CACHE and (state_cache_task is None or state_cache_task.done()):
+        state_cache_task = asyncio.get_running_loop().create_task(flush_state_later())
+
+async def flush_state_later():
+    global state_cache_dirty, state_cache_write
+    loop = asyncio.get_running_loop()
+    while state_cache_dirty:
+        await asyncio.sleep(STATE_CACHE_DELAY)
+        state_cache_dirty = False
+        try:
+            state_cache_write = loop.run_in_executor(None, write_bytes_atomic, STATE_CACHE, dump_state_cache())
+            await asyncio.shield(state_cache_write)
+        except Exception as e:
+            state_cache_dirty = True
+            print(f"[ERROR] Не удалось сохранить снимок состояния: {e}")
+
+def open_sent_store(path=None, state=None):
+    """Открывает журнал отправленных напоминаний (SQLite в режиме WAL).
+
+    Ключ напоминания — три целых числа: id ученика, минута эпохи занятия и
+    тип напоминания, поэтому после перезапуска повторно ничего не уходит.
+    Множество в памяти можно взять из снимка состояния: то, чего в нём не
+    хватает, отсечёт INSERT OR IGNORE.
+    """
+    global sent_db, sent_reminders
+    sent_db = sqlite3.connect(path or SENT_DB, isolation_level=None)
+    sent_db.execute("PRAGMA journal_mode=WAL")
+    sent_db.execute("PRAGMA synchronous=NORMAL")
+    sent_db.execute("PRAGMA busy_timeout=5000")
+    sent_db.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+    sent_db.execute(
+        "CREATE TABLE IF NOT EXISTS sent ("
+        "minute INTEGER NOT NULL, user_id INTEGER NOT NULL, kind INTEGER NOT NULL, "
+        "PRIMARY KEY (minute, user_id, kind)) WITHOUT ROWID"
+    )
+    sent_db.execute(
+        "CREATE TABLE IF NOT EXISTS outbox ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, text TEXT NOT NULL, "
+        "owner TEXT NOT NULL, created REAL NOT NULL, dead INTEGER NOT NULL DEFAULT 0)"
+    )
+    sent_user_ids.clear()
+    if state is not None and state["sent_db"] == os.path.abspath(path or SENT_DB):
+        sent_user_ids.update(state["sent_user_ids"])
+        sent_reminders = state["sent"]
+        return
+    sent_user_ids.update({name: uid for uid, name in sent_db.execute("SELECT id, name FROM users")})
+    sent_reminders = {
+        (uid, minute, kind) for minute, uid, kind in sent_db.execute("SELECT minute, user_id, kind FROM sent")
     }
 
-def reset_schedule_to_default():
-    global temporary_schedule
+def sent_user_id(user_name):
+    uid = sent_user_ids.get(user_name)
+    if uid is None:
+        sent_db.execute("INSERT OR IGNORE INTO users (name) VALUES (?)", (user_name,))
+        uid = sent_db.execute("SELECT id FROM users WHERE name = ?", (user_name,)).fetchone()[0]
+        sent_user_ids[user_name] = uid
+    return uid
+
+def claim_reminder(user_name, lesson_at, kind):
+    """Атомарно помечает напоминание отправленным. False — если оно уже было."""
+    key = (sent_user_id(user_name), int(lesson_at) // 60, REMINDER_KINDS[kind])
+    if key in sent_reminders:
+        return False
+    cursor = sent_db.execute("INSERT OR IGNORE INTO sent (user_id, minute, kind) VALUES (?, ?, ?)", key)
+    sent_reminders.add(key)
+    return cursor.rowcount == 1
+
+def release_reminder(user_name, lesson_at, kind):
+    """Снимает отметку claim_reminder с напоминания, которое так и не ушло в рассылку."""
+    key = (sent_user_id(user_name), int(lesson_at) // 60, REMINDER_KINDS[kind])
+    sent_db.execute("DELETE FROM sent WHERE user_id = ? AND minute = ? AND kind = ?", key)
+    sent_reminders.discard(key)
+
+async def clean_sent_reminders():
+    global sent_reminders
+    now_minute = int(clock.time()) // 60
+    sent_db.execute("DELETE FROM sent WHERE minute <= ?", (now_minute,))
+    sent_db.execute("DELETE FROM outbox WHERE dead = 1 AND created < ?", (time.time() - OUTBOX_DEAD_TTL,))
+    sent_reminders = {k for k in sent_reminders if k[1] > now_minute}
+    reminders_sent_ahead.difference_update([k for k in reminders_sent_ahead if k[1] // 60 <= now_minute])
+
+def open_cluster():
+    sent_db.execute("CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, heartbeat REAL NOT NULL)")
+    sent_db.execute(
+        "CREATE TABLE IF NOT EXISTS chats (user TEXT PRIMARY KEY, chat_id INTEGER NOT NULL, version INTEGER NOT NULL)"
+    )
+    sent_db.execute("CREATE INDEX IF NOT EXISTS chats_version ON chats (version)")
+    sent_db.execute(
+        "CREATE TABLE IF NOT EXISTS poller (id INTEGER PRIMARY KEY CHECK (id = 1), worker TEXT NOT NULL, heartbeat REAL NOT NULL)"
+    )
+    # Режим ввода админа: следующее сообщение может прийти на другой воркер
+    sent_db.execute("CREATE TABLE IF NOT EXISTS chat_modes (chat_id INTEGER PRIMARY KEY, mode TEXT NOT NULL)")
+    # Известные нам chat_id — в общую базу, чтобы их видели все воркеры
+    for user_name, chat_id in user_data.items():
+        if chat_id:
+            sent_db.execute(
+                "INSERT OR IGNORE INTO chats (user, chat_id, version) "
+                "VALUES (?, ?, (SELECT COALESCE(MAX(version), 0) + 1 FROM chats))",
+                (user_name, chat_id),
+            )
+    print(f"[INFO] Кластерный режим: воркер {WORKER_ID}, база {CLUSTER_DB}")
+
+def claim_poller():
+    """Аренда на getUpdates: два опрашивающих процесса получают от Telegram 409 Conflict."""
+    now = time.time()
+    sent_db.execute(
+        "INSERT INTO poller (id, worker, heartbeat) VALUES (1, ?, ?) "
+        "ON CONFLICT(id) DO UPDATE SET worker = excluded.worker, heartbeat = excluded.heartbeat "
+        "WHERE poller.worker = excluded.worker OR poller.heartbeat < ?",
+        (WORKER_ID, now, now - CLUSTER_LEASE),
+    )
+    return sent_db.execute("SELECT worker FROM poller").fetchone()[0] == WORKER_ID
+
+async def cluster_heartbeat():
+    """Продлевает аренду воркера, обновляет состав кластера и общие данные."""
+    global cluster_workers, cluster_chats_version, chat_members_cache
+    now = time.time()
+    sent_db.execute(
+        "INSERT INTO workers (id, heartbeat) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET heartbeat = excluded.heartbeat",
+        (WORKER_ID, now),
+    )
+    sent_db.execute("DELETE FROM workers WHERE heartbeat < ?", (now - CLUSTER_LEASE * 10,))
+    workers = [row[0] for row in sent_db.execute(
+        "SELECT id FROM workers WHERE heartbeat >= ? ORDER BY id", (now - CLUSTER_LEASE,)
+    )]
+    changed = workers != cluster_workers
+    if changed:
+        print(f"[INFO] Состав кластера: {workers}")
+        metrics.inc("cluster_membership_changes_total")
+    cluster_workers = workers
+    if changed:
+        # Один бот — один лимит Telegram на всех воркеров
+        rate_limiter.set_rate(SEND_RATE / max(1, len(workers)))
+    if cluster_poller and not claim_poller():
+        # Пока мы стояли, аренду забрал другой воркер — второй опрос getUpdates только мешал бы обоим
+        print("[ERROR] Аренда на getUpdates перешла к другому воркеру, останавливаемся")
+        signal.raise_signal(signal.SIGTERM)
+    if changed and broadcaster:
+        # Недоставленное выбывшими воркерами забираем себе
+        broadcaster.replay()
+
+    for user_name, chat_id, version in sent_db.execute(
+        "SELECT user, chat_id, version FROM chats WHERE version > ?", (cluster_chats_version,)
+    ):
+        user_data[user_name] = chat_id
+        chat_members_cache = None
+        cluster_chats_version = max(cluster_chats_version, version)
+
+    with journal_lock():
+        catch_up_journal()
+
+def is_leader():
+    return not CLUSTER_DB or cluster_workers[:1] == [WORKER_ID]
+
+def set_chat_mode(update, context, mode):
+    """Запоминает, что следующее сообщение чата — ввод для режима mode."""
+    if CLUSTER_DB:
+        sent_db.execute("INSERT OR REPLACE INTO chat_modes (chat_id, mode) VALUES (?, ?)", (update.effective_chat.id, mode))
+    else:
+        context.chat_data["mode"] = mode
+
+def pop_chat_mode(update, context):
+    """Снимает и возвращает режим ввода чата; None — режима нет."""
+    if not CLUSTER_DB:
+        return context.chat_data.pop("mode", None)
+    chat_id = update.effective_chat.id
+    row = sent_db.execute("SELECT mode FROM chat_modes WHERE chat_id = ?", (chat_id,)).fetchone()
+    if row is None:
+        return None
+    # Режим забирает тот воркер, чей DELETE прошёл первым
+    cursor = sent_db.execute("DELETE FROM chat_modes WHERE chat_id = ? AND mode = ?", (chat_id, row[0]))
+    return row[0] if cursor.rowcount == 1 else None
+
+def owns_user(user_name):
+    """Отвечает ли этот воркер за напоминания ученика (шардирование по хешу имени)."""
+    if not CLUSTER_DB:
+        return True
+    if WORKER_ID not in cluster_workers:
+        return False
+    shard = zlib.crc32(user_name.encode("utf-8")) % len(cluster_workers)
+    return cluster_workers[shard] == WORKER_ID
+
+def fetch_remote_schedule(url):
+    """Условный GET: None, если с прошлого раза файл не менялся (304)."""
+    global sync_etag, sync_last_modified
+    import requests
+
+    headers = {}
+    if sync_etag:
+        headers["If-None-Match"] = sync_etag
+    if sync_last_modified:
+        headers["If-Modified-Since"] = sync_last_modified
+    response = requests.get(url, headers=headers, timeout=15)
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    sync_etag = response.headers.get("ETag")
+    sync_last_modified = response.headers.get("Last-Modified")
+    return response.json()
+
+def sync_changes(data):
+    """Разница между новой версией users.json и памятью: {ученик: данные или None}."""
+    incoming = {u: d for u, d in data.items() if isinstance(d, dict) and 'schedule' in d}
+    base_seq = data.get("_journal", {}).get("seq") if isinstance(data.get("_journal"), dict) else None
+    if base_seq is not None:
+        # Это наш снимок (возможно, поправленный руками): доигрываем журнал поверх него,
+        # чтобы не откатить правки, сделанные после записи снимка
+        for path in (JOURNAL_FILE + ".old", JOURNAL_FILE):
+            for record in read_journal(path):
+                if record["seq"] > base_seq:
+                    apply_schedule_change(record, incoming)
+    changes = {u: d for u, d in incoming.items() if temporary_schedule.get(u) != d}
+    changes.update({u: None for u in temporary_schedule if u not in incoming})
+    return changes
+
+async def apply_sync(data, source):
+    """Переносит в расписание отличия data; True — если что-то поменялось."""
+    changes = sync_changes(data)
+    if not changes:
+        return False
+    async with locked_students(*changes):
+        # Пока ждали замки, правки админа могли поменять расписание — считаем разницу заново
+        changes = sync_changes(data)
+        if not changes:
+            return False
+        commit_schedule_change({"op": "sync", "users": changes})
+    metrics.inc("schedule_sync_changes_total", len(changes), source=source)
+    print(f"[INFO] Расписание обновлено из {source}: учеников изменено {len(changes)}")
+    return True
+
+async def snapshot_now():
+    """Переписывает снимок, не дожидаясь JOURNAL_COMPACT_EVERY правок."""
+    if compaction_task and not compaction_task.done():
+        await compaction_task
+    compact_journal()
+    await compaction_task
+
+async def sync_remote_schedule():
+    if not is_leader():
+        return
     try:
-        with open("default_users.json", "r", encoding="utf-8") as f:
-            default_data = json.load(f)
-        with open("users.json", "w", encoding="utf-8") as f:
-            json.dump(default_data, f, ensure_ascii=False, indent=4)
-        temporary_schedule = default_data
-        print("[INFO] Расписание сброшено к стандартному")
+        data = await asyncio.get_running_loop().run_in_executor(None, fetch_remote_schedule, SYNC_URL)
     except Exception as e:
-        print(f"[ERROR] Не удалось сбросить расписание: {e}")
+        print(f"[WARN] Не удалось получить расписание с {SYNC_URL}: {e}")
+        return
+    if data is not None:
+        await apply_sync(data, "url")
 
-async def safe_send(bot, chat_id, text):
+async def watch_schedule_file():
+    global schedule_file_mtime
     try:
-        await bot.send_message(chat_id=chat_id, text=text)
-    except RetryAfter as e:
-        await asyncio.sleep(e.retry_after)
-        await safe_send(bot, chat_id, text)
-    except (NetworkError, TimedOut):
-        await asyncio.sleep(5)
-        await safe_send(bot, chat_id, text)
-    except Exception as e:
-        print(f"[ERROR] {e}")
+        mtime = os.stat(SCHEDULE_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return
+    if mtime == schedule_file_mtime:
+        return
+    if not is_leader():
+        # Изменения применяет лидер, остальные получат их через журнал,
+        # а снимок после сжатия журнала перечитает catch_up_journal
+        return
+    data = read_schedule_file()
+    if data is None:
+        return
+    schedule_file_mtime = mtime
+    if await apply_sync(data, "file"):
+        # В users.json остался старый _journal.seq: без нового снимка журнал с этой
+        # правкой доигрывался бы поверх следующей ручной правки и после перезапуска
+        await snapshot_now()
+
+class RateLimiter:
+    """Общий token bucket на все чаты плюс минимальный интервал для каждого чата.
+
+    RetryAfter от Telegram относится ко всему боту, поэтому pause() останавливает
+    выдачу токенов всем воркерам рассылки, а не только получившему 429. Лимит
+    Telegram общий и для процессов кластера — каждый берёт свою долю через set_rate().
+    """
+
+    def __init__(self, rate=SEND_RATE, per_chat_interval=PER_CHAT_INTERVAL):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.per_chat_interval = per_chat_interval
+        self.chat_next = {}  # chat_id -> когда в этот чат снова можно писать
+        self.paused_until = 0.0
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.tokens = min(self.tokens, max(rate, 1.0))
+
+    def pause(self, delay):
+        """Флуд-контроль: никто не отправляет ещё delay секунд, после паузы — без накопленного запаса."""
+        until = time.monotonic() + delay
+        if until > self.paused_until:
+            self.paused_until = until
+            self.tokens = 0.0
+            self.updated = until
+
+    async def acquire(self, chat_id):
+        # Бронируем слот чата заранее, чтобы параллельные воркеры не писали в него одновременно
+        now = time.monotonic()
+        slot = max(now, self.chat_next.get(chat_id, 0.0))
+        self.chat_next[chat_id] = slot + self.per_chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+rate_limiter = RateLimiter()
+
+async def safe_send(bot, chat_id, text):
+    """Отправляет сообщение с ограниченным числом повторов.
+
+    True — доставлено, False — Telegram отверг сообщение, None — попытки
+    кончились на сетевых ошибках и сообщение можно повторить позже.
+    """
+    for attempt in range(SEND_MAX_ATTEMPTS):
+        await rate_limiter.acquire(chat_id)
+        start = time.perf_counter()
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+            metrics.observe("send_seconds", time.perf_counter() - start)
+            metrics.inc("messages_sent_total")
+            return True
+        except RetryAfter as e:
+            delay = e.retry_after
+            rate_limiter.pause(delay)
+            metrics.inc("retry_after_total")
+            metrics.inc("retry_after_wait_seconds_total", delay)
+        except (NetworkError, TimedOut):
+            delay = min(SEND_BACKOFF_CAP, SEND_BACKOFF_BASE * 2 ** attempt)
+            metrics.inc("network_errors_total")
+        except Exception as e:
+            print(f"[ERROR] {e}")
+            metrics.inc("send_failures_total")
+            return False
+        if attempt == SEND_MAX_ATTEMPTS - 1:
+            break
+        metrics.inc("send_retries_total")
+        print(f"[WARN] Повтор отправки в {chat_id} через {delay} с (попытка {attempt + 1})")
+        await asyncio.sleep(delay)
+    return None
+
+class Broadcaster:
+    """Пул воркеров, разбирающих исходящие сообщения из outbox.
+
+    Сообщение сначала записывается в таблицу outbox и удаляется из неё только
+    после подтверждения Telegram, так что после падения недоставленное уходит
+    повторно. Медленный чат задерживает только своего воркера; пока Telegram
+    недоступен, сообщение откладывается, а отвергнутое помечается в outbox как dead.
+    """
+
+    def __init__(self, bot, workers=SEND_WORKERS):
+        self.bot = bot
+        self.queue = asyncio.Queue()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(workers)]
+
+    def submit(self, chat_id, text):
+        """Ставит сообщение в outbox и сразу возвращается — Telegram не ждём."""
+        cursor = sent_db.execute(
+            "INSERT INTO outbox (chat_id, text, owner, created) VALUES (?, ?, ?, ?)",
+            (chat_id, text, WORKER_ID, time.time()),
+        )
+        self.queue.put_nowait((cursor.lastrowid, chat_id, text))
+        metrics.inc("send_queue_submitted_total")
+
+    def replay(self, startup=False):
+        """Забирает из outbox недоставленное прошлым запуском и выбывшими воркерами кластера."""
+        live = [w for w in cluster_workers if not (startup and w == WORKER_ID)]
+        rows = sent_db.execute(
+            f"SELECT id, chat_id, text, owner FROM outbox WHERE dead = 0 AND owner NOT IN ({','.join('?' * len(live))}) "
+            "ORDER BY id",
+            live,
+        ).fetchall()
+        claimed = 0
+        for outbox_id, chat_id, text, owner in rows:
+            # Другой воркер мог забрать то же сообщение раньше нас
+            if sent_db.execute("UPDATE outbox SET owner = ? WHERE id = ? AND owner = ?",
+                               (WORKER_ID, outbox_id, owner)).rowcount:
+                self.queue.put_nowait((outbox_id, chat_id, text))
+                claimed += 1
+        if claimed:
+            metrics.inc("outbox_replayed_total", claimed)
+            print(f"[INFO] Из outbox повторно поставлено сообщений: {claimed}")
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            outbox_id, chat_id, text = item
+            try:
+                sent = await safe_send(self.bot, chat_id, text)
+                if sent:
+                    sent_db.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
+                elif sent is None:
+                    # Сообщение остаётся в outbox; если мы упадём раньше, его поднимет replay
+                    metrics.inc("outbox_deferred_total")
+                    asyncio.get_running_loop().call_later(OUTBOX_RETRY_DELAY, self.queue.put_nowait, item)
+                else:
+                    sent_db.execute("UPDATE outbox SET dead = 1 WHERE id = ?", (outbox_id,))
+                    metrics.inc("dead_letters_total")
+                    print(f"[ERROR] Сообщение в {chat_id} не доставлено")
+            finally:
+                self.queue.task_done()
+
+    async def stop(self, timeout=30):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"[WARN] Не отправлено сообщений при остановке: {self.queue.qsize()}, они останутся в outbox")
+        for worker in self.workers:
+            worker.cancel()
 
 async def update_user_data():
-    global user_data
-    for user in temporary_schedule:
+    schedule = schedule_snapshot()
+    for user in schedule:
         if user not in user_data:
             user_data[user] = None
     for user in list(user_data.keys()):
-        if user not in temporary_schedule:
+        if user not in schedule:
             del user_data[user]
 
-async def send_reminders_24h(app):
-    now = datetime.now(local_tz)
-    for user_name, data in temporary_schedule.items():
+class Lesson:
+    """Скомпилированный урок: день недели и минута дня уже посчитаны."""
+
+    __slots__ = ("weekday", "minute", "description", "date")
+
+    def __init__(self, weekday, minute, description, date=None):
+        self.weekday = weekday
+        self.minute = minute
+        self.description = description
+        self.date = date  # у разового урока — его дата, у урока из базы None
+
+    @property
+    def day(self):
+        return DAYS[self.weekday]
+
+    @property
+    def time(self):
+        return f"{self.minute // 60:02d}:{self.minute % 60:02d}"
+
+def parse_slot(day, time_str):
+    """(день недели, минута дня) по строкам вида «Среда», «13:00»; ValueError при ошибке."""
+    # Значения приходят из JSON админа и users.json — там может оказаться не строка
+    if not isinstance(day, str) or day not in DAY_INDEX:
+        raise ValueError(f"некорректный день недели {day}")
+    if not isinstance(time_str, str):
+        raise ValueError(f"некорректное время {time_str}")
+    hours, minutes = map(int, time_str.split(":"))
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"некорректное время {time_str}")
+    return DAY_INDEX[day], hours * 60 + minutes
+
+def lesson_slot(lesson):
+    try:
+        return parse_slot(lesson["day"], lesson["time"])
+    except (KeyError, ValueError):
+        return None
+
+def compile_lesson(lesson, date=None):
+    weekday, minute = parse_slot(lesson["day"], lesson["time"])
+    return Lesson(weekday, minute, lesson.get("description", ""), date)
+
+def find_lesson(user_name, slot):
+    """Позиция урока ученика в данном слоте или None."""
+    index = lesson_index.get(user_name)
+    if index is not None:
+        return index.get(slot)
+    # Индекс ещё не построен (доигрывание журнала при загрузке)
+    lessons = temporary_schedule.get(user_name, {}).get("schedule", [])
+    return next((i for i, l in enumerate(lessons) if lesson_slot(l) == slot), None)
+
+def compile_user(user_name):
+    for slot in lesson_index.pop(user_name, {}):
+        users = slot_index.get(slot)
+        users.discard(user_name)
+        if not users:
+            del slot_index[slot]
+    data = temporary_schedule.get(user_name)
+    if data is None:
+        compiled_schedule.pop(user_name, None)
+        user_tz.pop(user_name, None)
+        return
+    tz_name = data.get("tz") or DEFAULT_TZ
+    try:
+        ZoneInfo(tz_name)
+    except (ZoneInfoNotFoundError, ValueError):
+        print(f"[WARN] Неизвестный часовой пояс {tz_name} у {user_name}, используем {DEFAULT_TZ}")
+        tz_name = DEFAULT_TZ
+    user_tz[user_name] = tz_name
+    lessons = []
+    index = {}
+    for position, lesson in enumerate(data["schedule"]):
+        try:
+            compiled = compile_lesson(lesson)
+        except (KeyError, ValueError) as e:
+            print(f"[WARN] Пропущен некорректный урок у {user_name}: {lesson} ({e})")
+            continue
+        lessons.append(compiled)
+        slot = (compiled.weekday, compiled.minute)
+        index.setdefault(slot, position)
+        slot_index.setdefault(slot, set()).add(user_name)
+    compiled_schedule[user_name] = tuple(lessons)
+    lesson_index[user_name] = index
+
+def occurrence_date(slot, now=None):
+    """Дата ближайшего ещё не начавшегося занятия в этом слоте — к ней привязываются разовые правки."""
+    weekday, minute = slot
+    now = now or clock.now()
+    days = (weekday - now.weekday()) % 7
+    if days == 0 and minute <= now.hour * 60 + now.minute:
+        days = 7
+    return now.date() + timedelta(days=days)
+
+def apply_overlay_change(record):
+    """Разовая правка на конкретную дату; базовое расписание не трогаем."""
+    users = schedule_overlay.setdefault(record["date"], {})
+    user_name = record["user"]
+    if record["op"] in ("delete", "move"):
+        entry = users.get(user_name, {"cancel": [], "add": []})
+        minute = parse_slot(record["day"], record["time"])[1]
+        once = [l for l in entry["add"] if lesson_slot(l)[1] != minute]
+        if len(once) != len(entry["add"]):
+            users[user_name] = {**entry, "add": once}  # отменяется разовый урок
+        elif minute not in entry["cancel"]:
+            users[user_name] = {**entry, "cancel": entry["cancel"] + [minute]}  # отменяется урок из базы
+    if record["op"] in ("add", "move"):
+        users = schedule_overlay.setdefault(record.get("new_date", record["date"]), {})
+        entry = users.get(user_name, {"cancel": [], "add": []})
+        users[user_name] = {**entry, "add": entry["add"] + [record["lesson"]]}
+
+def prune_overlay(today=None):
+    """Выбрасывает правки за прошедшие даты: каждая дата удаляется одним ключом.
+
+    Даты записаны в поясе ученика, а «сегодня» здесь — в поясе бота: к западу
+    от него вчерашний день ещё идёт, поэтому правки хранятся на сутки дольше.
+    """
+    cutoff = ((today or clock.now().date()) - timedelta(days=1)).isoformat()
+    expired = [d for d in schedule_overlay if d < cutoff]
+    for date_iso in expired:
+        del schedule_overlay[date_iso]
+    return expired
+
+async def expire_overlay():
+    expired = prune_overlay()
+    if expired:
+        bump_schedule_version()
+        mark_state_dirty()
+        print(f"[INFO] Истекли разовые правки за {', '.join(sorted(expired))}")
+
+def day_lessons(user_name, date):
+    """Уроки ученика в конкретную дату: база без отменённых плюс разовые."""
+    entry = schedule_overlay.get(date.isoformat(), {}).get(user_name)
+    weekday = date.weekday()
+    lessons = [
+        l for l in compiled_schedule.get(user_name, ())
+        if l.weekday == weekday and not (entry and l.minute in entry["cancel"])
+    ]
+    if entry:
+        lessons += [compile_lesson(l, date) for l in entry["add"]]
+    return sorted(lessons, key=lambda l: l.minute)
+
+def week_lessons(user_name, now=None):
+    """Уроки ученика на семь дней начиная с его сегодняшнего дня."""
+    today = (now or student_now(user_name)).date()
+    return [l for d in range(7) for l in day_lessons(user_name, today + timedelta(days=d))]
+
+def student_zone(user_name):
+    return ZoneInfo(user_tz.get(user_name, DEFAULT_TZ))
+
+def student_now(user_name):
+    """Текущее время в поясе ученика — в нём записаны дни и часы его уроков."""
+    return clock.now(student_zone(user_name))
+
+def find_week_lesson(user_name, slot, now=None):
+    """Ближайшее занятие ученика в этом слоте с учётом разовых правок: (урок или None, дата)."""
+    date = occurrence_date(slot, now or student_now(user_name))
+    lesson = next((l for l in day_lessons(user_name, date) if l.minute == slot[1]), None)
+    return lesson, date
+
+def compile_schedule():
+    compiled_schedule.clear()
+    lesson_index.clear()
+    slot_index.clear()
+    for user_name in temporary_schedule:
+        compile_user(user_name)
+
+def schedule_zones():
+    """Пояса, в которых записаны уроки; пересчитываются не чаще раза на версию расписания."""
+    global current_zones
+    if current_zones is None or current_zones[0] != schedule_version:
+        current_zones = (schedule_version, sorted(set(user_tz.values()) | {DEFAULT_TZ}))
+    return current_zones[1]
+
+def slot_conflicts(user_name, slot, ignore=None, date=None):
+    """Накладки для урока в слоте: (есть ли у самого ученика, другие ученики).
+
+    Слоты учеников записаны в их собственных поясах, поэтому урок сначала
+    переводится в момент времени, а затем в каждом поясе смотрятся только
+    соседние минуты этого момента — стоимость не зависит от числа учеников.
+    Без даты берётся ближайшее занятие в слоте; разовые правки учитываются.
+    """
+    tz_name = user_tz.get(user_name, DEFAULT_TZ)
+    date = date or occurrence_date(slot, student_now(user_name))
+    start = local_timestamp(tz_name, date, slot[1])
+    busy = []  # (ученик, слот урока в его поясе)
+    for zone in schedule_zones():
+        local = datetime.fromtimestamp(start, ZoneInfo(zone))
+        for delta in range(1 - LESSON_MINUTES, LESSON_MINUTES):
+            moment = local + timedelta(minutes=delta)
+            other_slot = (moment.weekday(), moment.hour * 60 + moment.minute)
+            overlay = schedule_overlay.get(moment.date().isoformat(), {})
+            busy += [
+                (other, other_slot) for other in slot_index.get(other_slot, ())
+                if user_tz.get(other, DEFAULT_TZ) == zone and not (other in overlay and other_slot[1] in overlay[other]["cancel"])
+            ]
+    # Разовые уроки: даты в соседних поясах отличаются от нашей не больше чем на двое суток
+    for days in range(-2, 3):
+        day = date + timedelta(days=days)
+        for other, entry in schedule_overlay.get(day.isoformat(), {}).items():
+            for lesson in entry["add"]:
+                other_slot = lesson_slot(lesson)
+                lesson_at = local_timestamp(user_tz.get(other, DEFAULT_TZ), day, other_slot[1]) if other_slot else None
+                if lesson_at is not None and abs(lesson_at - start) < LESSON_MINUTES * 60:
+                    busy.append((other, other_slot))
+    own, others = False, set()
+    for other, other_slot in busy:
+        if other != user_name:
+            others.add(other)
+        elif other_slot != ignore:
+            own = True
+    return own, sorted(others)
+
+def conflict_warning(others):
+    return f"\n⚠️ В это же время занимаются: {', '.join(others)}" if others else ""
+
+CANCELLATION_RULES = (
+    "⏰ Утренние занятия (до 12:00) – предупреждаем за день, иначе занятие сгорает.\n"
+    "⏰ Изменения возможны до 20:00 накануне (для занятий до 12:00) или минимум за 4 часа (для занятий после 12:00)."
+)
+
+def reminder_text(kind, lesson):
+    if kind == "24h":
+        return (
+            f"Hello! 😊 Напоминаем о Вашем предстоящем занятии в {lesson.day} в {lesson.time}.\n"
+            f"Если планы изменятся – пожалуйста, предупредите заранее. 😉\n\n"
+            f"{CANCELLATION_RULES}"
+        )
+    return (
+        f"Hey there! 🕒 Напоминаем, что у Вас сегодня занятие по английскому в {lesson.time}.\n"
+        f"⌛️ Если опаздываете на 5–10 минут, просто дайте знать."
+    )
+
+def local_timestamp(tz_name, date, minute):
+    """Секунды эпохи для даты и минуты дня в поясе; переходы на летнее время учитывает zoneinfo."""
+    local = datetime.combine(date, datetime.min.time()) + timedelta(minutes=minute)
+    return int(local.replace(tzinfo=ZoneInfo(tz_name)).timestamp())
+
+@functools.lru_cache(maxsize=16384)
+def slot_occurrences(tz_name, weekday, minute, monday):
+    """UTC-моменты занятий слота на OCCURRENCE_WEEKS недель начиная с понедельника monday.
+
+    Таблица считается один раз на пояс, слот и неделю: у всего расписания
+    лишь несколько сотен различных слотов.
+    """
+    return tuple(
+        local_timestamp(tz_name, monday + timedelta(days=7 * week + weekday), minute)
+        for week in range(OCCURRENCE_WEEKS)
+    )
+
+def next_occurrence(tz_name, lesson, after):
+    """Первое занятие по постоянному расписанию не раньше момента after (секунды эпохи)."""
+    today = datetime.fromtimestamp(after, ZoneInfo(tz_name)).date()
+    monday = today - timedelta(days=today.weekday())
+    for lesson_at in slot_occurrences(tz_name, lesson.weekday, lesson.minute, monday):
+        if lesson_at >= after:
+            return lesson_at
+
+def push_reminder(user_name, lesson, kind, lesson_at):
+    fire_at = lesson_at - REMINDER_OFFSETS[kind]
+    generation = reminder_generation.get(user_name, 0)
+    heapq.heappush(reminder_heap, (fire_at, next(_reminder_seq), user_name, generation, kind, lesson_at, lesson))
+
+def wake_reminder_loop():
+    if reminder_wakeup is not None:
+        reminder_wakeup.set()
+
+def schedule_user_reminders(user_name, now=None):
+    """Пересчитывает напоминания одного ученика после изменения его расписания.
+
+    Старые записи в куче не удаляются: они помечаются устаревшими через
+    поколение и отбрасываются при извлечении.
+    """
+    now = clock.time() if now is None else now
+    tz_name = user_tz.get(user_name, DEFAULT_TZ)
+    reminder_generation[user_name] = reminder_generation.get(user_name, 0) + 1
+    for lesson in compiled_schedule.get(user_name, ()):
+        for kind, offset in REMINDER_OFFSETS.items():
+            # Ближайшее занятие, напоминание о котором ещё не просрочено
+            push_reminder(user_name, lesson, kind, next_occurrence(tz_name, lesson, now + offset - REMINDER_GRACE))
+    # Разовые уроки не повторяются: по одному напоминанию каждого типа на их дату
+    for date_iso, users in schedule_overlay.items():
+        if user_name not in users:
+            continue
+        date = datetime.fromisoformat(date_iso).date()
+        for lesson in day_lessons(user_name, date):
+            if lesson.date is None:
+                continue
+            lesson_at = local_timestamp(tz_name, date, lesson.minute)
+            for kind, offset in REMINDER_OFFSETS.items():
+                if lesson_at - offset + REMINDER_GRACE >= now:
+                    push_reminder(user_name, lesson, kind, lesson_at)
+    wake_reminder_loop()
+
+def rebuild_reminders():
+    global reminder_heap
+    now = clock.time()
+    reminder_heap = []
+    schedule = schedule_snapshot()
+    for user_name in list(reminder_generation):
+        if user_name not in schedule:
+            reminder_generation[user_name] += 1
+    for user_name in schedule:
+        schedule_user_reminders(user_name, now)
+    print(f"[INFO] Очередь напоминаний построена: {len(reminder_heap)} записей")
+
+def reminder_cancelled(user_name, lesson, lesson_at):
+    """Урок из базы мог быть разово отменён или перенесён именно в эту дату."""
+    if lesson.date is not None or not schedule_overlay:
+        return False
+    lesson_date = datetime.fromtimestamp(lesson_at, student_zone(user_name)).date()
+    entry = schedule_overlay.get(lesson_date.isoformat(), {}).get(user_name)
+    return bool(entry) and lesson.minute in entry["cancel"]
+
+def digest_text(items):
+    """Текст для одного чата: одиночное напоминание как раньше, несколько — общим списком."""
+    if len(items) == 1:
+        kind, _, lesson, _ = items[0]
+        return reminder_text(kind, lesson)
+    lines = [f"• {lesson.day} в {lesson.time} – {lesson.description}" for _, _, lesson, _ in sorted(items, key=lambda i: i[1])]
+    return (
+        "Hello! 😊 Напоминаем о Ваших предстоящих занятиях:\n"
+        + "\n".join(lines)
+        + "\n\nЕсли планы изменятся – пожалуйста, предупредите заранее. 😉"
+        + (f"\n\n{CANCELLATION_RULES}" if any(kind == "24h" for kind, *_ in items) else "")
+    )
+
+def note_reminder(event, user_name, kind, lesson_at, now):
+    metrics.inc(f"reminders_{event}_total", kind=kind)
+    if reminder_observer:
+        reminder_observer(event, user_name, kind, lesson_at, now)
+
+def pull_digest_ahead(batch, now):
+    """Добавляет в дайджест напоминания тем же чатам, до которых осталось не больше DIGEST_WINDOW.
+
+    Из кучи ничего не извлекается: обходятся только поддеревья с корнем в окне,
+    а отправленные заранее записи пропускаются, когда до них дойдёт очередь.
+    """
+    bound = now + DIGEST_WINDOW
+    stack = [0] if reminder_heap else []
+    while stack:
+        i = stack.pop()
+        check_at, _, user_name, generation, kind, lesson_at, lesson = reminder_heap[i]
+        if check_at > bound:
+            continue
+        stack.extend(j for j in (2 * i + 1, 2 * i + 2) if j < len(reminder_heap))
         chat_id = user_data.get(user_name)
-        if not chat_id:
+        if (chat_id not in batch or generation != reminder_generation.get(user_name)
+                or check_at != lesson_at - REMINDER_OFFSETS[kind] or not owns_user(user_name)
+                or reminder_cancelled(user_name, lesson, lesson_at)):
+            continue
+        if claim_reminder(user_name, lesson_at, kind):
+            reminders_sent_ahead.add((user_name, lesson_at, kind))
+            batch[chat_id].append((kind, lesson_at, lesson, user_name))
+            note_reminder("sent", user_name, kind, lesson_at, now)
+            metrics.inc("reminders_sent_ahead_total", kind=kind)
+
+def pull_day_ahead(batch, now):
+    """Добавляет к напоминаниям за день остальные занятия того же дня у всех учеников чата.
+
+    У родителя с несколькими детьми занятия одного дня разнесены на часы, и
+    DIGEST_WINDOW их не объединит. Поэтому весь завтрашний день уходит одним
+    сообщением вместе с первым напоминанием о нём, а следующие напоминания
+    за день о том же дне пропускаются, когда до них дойдёт очередь.
+    """
+    for chat_id, items in batch.items():
+        days = {
+            (member, datetime.fromtimestamp(lesson_at, student_zone(member)).date())
+            for kind, lesson_at, _, _ in items if kind == "24h"
+            for member in chat_members(chat_id)
+        }
+        for member, date in days:
+            if not owns_user(member):
+                continue
+            tz_name = user_tz.get(member, DEFAULT_TZ)
+            for lesson in day_lessons(member, date):
+                lesson_at = local_timestamp(tz_name, date, lesson.minute)
+                # Просроченные до запуска напоминания не воскрешаем — как и в основном тике
+                if lesson_at - REMINDER_OFFSETS["24h"] + REMINDER_GRACE >= now and claim_reminder(member, lesson_at, "24h"):
+                    reminders_sent_ahead.add((member, lesson_at, "24h"))
+                    items.append(("24h", lesson_at, lesson, member))
+                    note_reminder("sent", member, "24h", lesson_at, now)
+                    metrics.inc("reminders_sent_ahead_total", kind="24h")
+
+async def submit_reminders(app, batch, now):
+    """Отдаёт собранные напоминания в рассылку; отданные чаты убирает из batch."""
+    # Несколько занятий одного чата (например, у детей одного родителя) — одним сообщением
+    if batch and DIGEST_BY_DAY:
+        pull_day_ahead(batch, now)
+    if batch and DIGEST_WINDOW:
+        pull_digest_ahead(batch, now)
+    while batch:
+        chat_id, items = next(iter(batch.items()))
+        if len(items) > 1:
+            metrics.inc("reminder_digests_total")
+            metrics.inc("reminders_coalesced_total", len(items) - 1)
+        if broadcaster:
+            broadcaster.submit(chat_id, digest_text(items))
+        else:
+            await safe_send(app.bot, chat_id, digest_text(items))
+        del batch[chat_id]
+
+def release_reminders(batch, now):
+    """Возвращает в очередь напоминания, отмеченные отправленными, но не отданные в рассылку."""
+    for items in batch.values():
+        for kind, lesson_at, lesson, user_name in items:
+            release_reminder(user_name, lesson_at, kind)
+            if (user_name, lesson_at, kind) in reminders_sent_ahead:
+                # Взятые заранее ещё лежат в куче — достаточно снять пометку
+                reminders_sent_ahead.discard((user_name, lesson_at, kind))
+            else:
+                heapq.heappush(reminder_heap, (now + 1, next(_reminder_seq), user_name,
+                                               reminder_generation.get(user_name), kind, lesson_at, lesson))
+    batch.clear()
+
+async def fire_due_reminders(app, now=None):
+    # Часовые пояса учтены при построении очереди, в тике только сравнения секунд эпохи
+    now = clock.time() if now is None else now
+    batch = {}  # chat_id -> [(тип, момент занятия, урок, ученик)]
+    try:
+        await collect_due_reminders(app, batch, now)
+        await submit_reminders(app, batch, now)
+    except BaseException:
+        # Отмена или ошибка после claim_reminder не должна оставить напоминание
+        # отмеченным отправленным, но не попавшим в outbox
+        release_reminders(batch, now)
+        raise
+
+async def collect_due_reminders(app, batch, now):
+    popped = 0
+    while reminder_heap and reminder_heap[0][0] <= now:
+        popped += 1
+        if popped % REMINDER_TICK_BATCH == 0:
+            # Большой пик не должен держать кнопки учеников; отмеченное отправленным
+            # уходит в outbox до того, как уступим event loop
+            await submit_reminders(app, batch, now)
+            await asyncio.sleep(0)
+        check_at, _, user_name, generation, kind, lesson_at, lesson = heapq.heappop(reminder_heap)
+        if generation != reminder_generation.get(user_name):
+            continue
+        fire_at = lesson_at - REMINDER_OFFSETS[kind]
+
+        if check_at == fire_at and lesson.date is None:
+            # Следующее напоминание о том же занятии — из таблицы моментов слота
+            push_reminder(user_name, lesson, kind, next_occurrence(user_tz.get(user_name, DEFAULT_TZ), lesson, lesson_at + 1))
+
+        if (user_name, lesson_at, kind) in reminders_sent_ahead:
+            reminders_sent_ahead.discard((user_name, lesson_at, kind))
+            continue
+        if reminder_cancelled(user_name, lesson, lesson_at):
+            note_reminder("cancelled", user_name, kind, lesson_at, now)
+            continue
+
+        if not owns_user(user_name):
+            if check_at == fire_at:
+                # Проверим ещё раз, когда истечёт аренда владельца: если он упал,
+                # ученик перейдёт к нам, а общий журнал отправленных не даст дубля
+                heapq.heappush(reminder_heap, (fire_at + CLUSTER_LEASE + CLUSTER_HEARTBEAT,
+                                               next(_reminder_seq), user_name, generation, kind, lesson_at, lesson))
+            continue
+        metrics.inc("reminders_due_total", kind=kind)
+        if now > fire_at + REMINDER_GRACE:
+            print(f"[WARN] Пропущено просроченное напоминание {kind} для {user_name}")
+            note_reminder("missed", user_name, kind, lesson_at, now)
             continue
-        for lesson in data['schedule']:
-            lesson_datetime = get_lesson_datetime(lesson['day'], lesson['time'])
-            reminder_time = lesson_datetime - timedelta(days=1)
-            key = (user_name, lesson_datetime.isoformat(), "24h")
-
-            if reminder_time <= now <= reminder_time + timedelta(minutes=15) and key not in sent_reminders_24h:
-                text = (
-                    f"Hello! 😊 Напоминаем о Вашем предстоящем занятии в {lesson['day']} в {lesson['time']}.\n"
-                    f"Если планы изменятся – пожалуйста, предупредите заранее. 😉\n\n"
-                    f"⏰ Утренние занятия (до 12:00) – предупреждаем за день, иначе занятие сгорает.\n"
-                    f"⏰ Изменения возможны до 20:00 накануне (для занятий до 12:00) или минимум за 4 часа (для занятий после 12:00)."
-                )
-                await safe_send(app.bot, chat_id, text)
-                sent_reminders_24h.add(key)
-                print(f"[DEBUG] Отправлено напоминание за 24 часа: {key}")
-
-async def send_reminders_1h(app):
-    now = datetime.now(local_tz)
-    for user_name, data in temporary_schedule.items():
         chat_id = user_data.get(user_name)
         if not chat_id:
+            note_reminder("no_chat", user_name, kind, lesson_at, now)
             continue
-        for lesson in data['schedule']:
-            lesson_datetime = get_lesson_datetime(lesson['day'], lesson['time'])
-            reminder_time = lesson_datetime - timedelta(hours=1)
-            key = (user_name, lesson_datetime.isoformat(), "1h")
-
-            if reminder_time <= now <= reminder_time + timedelta(minutes=15) and key not in sent_reminders_1h:
-                text = (
-                    f"Hey there! 🕒 Напоминаем, что у Вас сегодня занятие по английскому в {lesson['time']}.\n"
-                    f"⌛️ Если опаздываете на 5–10 минут, просто дайте знать."
-                )
-                await safe_send(app.bot, chat_id, text)
-                sent_reminders_1h.add(key)
-                print(f"[DEBUG] Отправлено напоминание за 1 час: {key}")
+        if not claim_reminder(user_name, lesson_at, kind):
+            note_reminder("duplicate", user_name, kind, lesson_at, now)
+            continue
+        note_reminder("sent", user_name, kind, lesson_at, now)
+        metrics.observe("reminder_lateness_seconds", now - fire_at, kind=kind)
+        batch.setdefault(chat_id, []).append((kind, lesson_at, lesson, user_name))
+        print(f"[DEBUG] Отправлено напоминание за {kind}: {user_name} "
+              f"{datetime.fromtimestamp(lesson_at, student_zone(user_name)).isoformat()}")
+
+async def reminder_loop(app):
+    """Спит до ближайшего напоминания; правки расписания будят цикл досрочно."""
+    global reminder_wakeup
+    reminder_wakeup = asyncio.Event()
+    rebuild_reminders()
+    ready = time.monotonic() - STARTED_AT
+    metrics.observe("startup_seconds", ready)
+    print(f"[INFO] Напоминания работают через {ready:.2f} с после запуска процесса")
+    while True:
+        try:
+            with metrics.timer("job_seconds", job="reminder_tick"):
+                await fire_due_reminders(app)
+        except Exception as e:
+            print(f"[ERROR] Ошибка в цикле напоминаний: {e}")
+        timeout = None
+        if reminder_heap:
+            timeout = max(reminder_heap[0][0] - clock.time(), 0)
+        reminder_wakeup.clear()
+        try:
+            await asyncio.wait_for(reminder_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
 async def test_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Тестовая команда для немедленной проверки напоминаний."""
-    app = context.application
     await update_user_data()  # Обновляем данные
-    await send_reminders_24h(app)  # Проверяем напоминания за 24 часа
-    await send_reminders_1h(app)   # Проверяем напоминания за 1 час
+    wake_reminder_loop()  # Цикл напоминаний отправит всё, что уже подошло по времени
     await update.message.reply_text("Тест напоминаний выполнен. Проверьте логи или Telegram!")
 
-def get_lesson_datetime(day, time_str):
-    now = datetime.now(local_tz)
-    days = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
-    day_idx = days.index(day)
-    now_idx = now.weekday()
-    days_ahead = (day_idx - now_idx) % 7
-    lesson_date = now.date() + timedelta(days=days_ahead)
-    lesson_time = datetime.strptime(time_str, "%H:%M").time()
-
-    naive_dt = datetime.combine(lesson_date, lesson_time)
-    lesson_datetime = local_tz.localize(naive_dt)
-
-    return lesson_datetime
-
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_name = update.effective_user.username or update.effective_user.first_name
     user_id = update.effective_chat.id
-    now = datetime.now(local_tz).strftime("%Y-%m-%d %H:%M:%S")
+    now = clock.now().strftime("%Y-%m-%d %H:%M:%S")
 
     welcome_text = (
         "Welcome! 😊👋\n"
@@ -178,12 +1612,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info(f"[START] Пользователь {user_name} ({user_id}) запустил бота в {now}")
 
     if user_id == ADMIN_ID:
-        user_data[user_name] = user_id
-        save_user_data()
+        set_chat_id(user_name, user_id)
         await update.message.reply_text(welcome_text, reply_markup=menu(True))
     elif user_name in temporary_schedule:
-        user_data[user_name] = user_id
-        save_user_data()
+        set_chat_id(user_name, user_id)
         await update.message.reply_text(welcome_text, reply_markup=menu(False))
     else:
         await update.message.reply_text("Вы не в расписании.")
@@ -193,58 +1625,70 @@ def menu(admin=False):
     if admin:
         buttons.append([KeyboardButton("Все расписания"), KeyboardButton("Ученики")])
         buttons.append([KeyboardButton("Редактировать расписание"), KeyboardButton("Удалить урок")])
-        buttons.append([KeyboardButton("Перенести занятие")])
+        buttons.append([KeyboardButton("Перенести занятие"), KeyboardButton("Массовый импорт")])
     else:
         buttons.append([KeyboardButton("Моё расписание")])
     return ReplyKeyboardMarkup(buttons, resize_keyboard=True)
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    start_time = time.perf_counter()
+    branch = await route_button(update, context)
+    metrics.observe("handler_seconds", time.perf_counter() - start_time, branch=branch)
+
+async def route_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Разбирает нажатие кнопки и возвращает название сработавшей ветки."""
     text = update.message.text
     user_id = update.effective_chat.id
 
     # 1. Проверка режима (редактирование, удаление, перенос)
-    if "mode" in context.user_data:
-        mode = context.user_data.pop("mode")
+    mode = pop_chat_mode(update, context)
+    if mode:
         if mode == "edit":
             await handle_admin_input(update, context)
         elif mode == "delete":
             await handle_delete_input(update, context)
         elif mode == "move":
             await handle_move_input(update, context)
-        return
+        elif mode == "bulk":
+            await handle_bulk_input(update, context)
+        return f"input_{mode}"
 
     # 2. Общие действия
     if text == "Старт":
         await start(update, context)
-        return
+        return "start"
     if text == "Моё расписание":
         await show_my_schedule(update)
-        return
+        return "my_schedule"
 
     # 3. Админские действия
     if user_id == ADMIN_ID:
         print(f"[DEBUG] Админ нажал кнопку: '{text}'")
         if text == "Все расписания":
             await show_all(update)
-            return
+            return "show_all"
         if text == "Ученики":
             await show_users(update)
-            return
+            return "show_users"
         if text == "Редактировать расписание":
-            context.user_data["mode"] = "edit"
+            set_chat_mode(update, context, "edit")
             await edit_schedule_prompt(update, context)
-            return
+            return "edit_prompt"
         if text == "Удалить урок":
-            context.user_data["mode"] = "delete"
+            set_chat_mode(update, context, "delete")
             await delete_schedule_prompt(update, context)
-            return
+            return "delete_prompt"
         if text == "Перенести занятие":
-            context.user_data["mode"] = "move"
             await move_schedule_prompt(update, context)
-            return
+            return "move_prompt"
+        if text == "Массовый импорт":
+            set_chat_mode(update, context, "bulk")
+            await bulk_schedule_prompt(update, context)
+            return "bulk_prompt"
 
     # 4. Неизвестная команда
     await update.message.reply_text("Неизвестная команда.")
+    return "unknown"
 
 async def handle_move_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != ADMIN_ID:
@@ -270,73 +1714,84 @@ async def handle_move_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"Ошибка: отсутствуют поля {missing}")
         return
 
-    if user_name not in temporary_schedule:
-        await update.message.reply_text("Пользователь не найден.")
-        return
-
-    lessons = temporary_schedule[user_name]["schedule"]
+    async with locked_students(user_name):
+        if user_name not in temporary_schedule:
+            await update.message.reply_text("Пользователь не найден.")
+            return
 
-    # Логирование текущих уроков для отладки
-    lesson_list_str = "\n".join([f"{l['day']} {l['time']}" for l in lessons])
-    await update.message.reply_text(f"📋 Текущее расписание:\n{lesson_list_str}")
+        # Логирование уроков ближайшей недели для отладки
+        lesson_list_str = "\n".join([f"{l['day']} {l['time']}" for l in week_view(user_name)])
+        await update.message.reply_text(f"📋 Расписание на неделю:\n{lesson_list_str}")
 
-    # Поиск
-    idx = next((i for i, l in enumerate(lessons)
-                if l["day"] == data["day"] and l["time"] == data["time"]), None)
-    if idx is None:
-        await update.message.reply_text("❗ Урок не найден. Проверьте день/время ещё раз.")
-        return
+        # Поиск
+        try:
+            old_slot = parse_slot(data["day"], data["time"])
+            new_slot = parse_slot(data["new_day"], data["new_time"])
+        except ValueError as e:
+            await update.message.reply_text(f"Ошибка: {e}. Формат времени HH:MM.")
+            return
+        lesson, old_date = find_week_lesson(user_name, old_slot)
+        if lesson is None:
+            await update.message.reply_text("❗ Урок не найден. Проверьте день/время ещё раз.")
+            return
 
-    # Перенос
-    lessons[idx]["day"] = data["new_day"]
-    lessons[idx]["time"] = data["new_time"]
+        new_date = occurrence_date(new_slot, student_now(user_name))
+        own, others = slot_conflicts(user_name, new_slot, ignore=old_slot if new_date == old_date else None, date=new_date)
+        if own:
+            await update.message.reply_text(f"❗ У {user_name} уже есть занятие в это время. Перенос отменён.")
+            return
 
-    with open("users.json", "w", encoding="utf-8") as f:
-        json.dump(temporary_schedule, f, ensure_ascii=False, indent=4)
+        # Перенос только этого занятия: база остаётся прежней
+        commit_schedule_change({"op": "move", "user": user_name, "day": data["day"], "time": data["time"],
+                                "date": old_date.isoformat(), "new_day": data["new_day"], "new_time": data["new_time"],
+                                "new_date": new_date.isoformat(),
+                                "lesson": {"day": data["new_day"], "time": data["new_time"], "description": lesson.description}})
 
     await update.message.reply_text(
-        f"✅ Урок у {user_name} перенесён:\n"
-        f"{data['day']} {data['time']} → {data['new_day']} {data['new_time']}"
+        f"✅ Урок у {user_name} перенесён разово:\n"
+        f"{data['day']} {old_date:%d.%m} {data['time']} → {data['new_day']} {new_date:%d.%m} {data['new_time']}"
+        f"{conflict_warning(others)}"
     )
 
     chat_id = user_data.get(user_name)
     if chat_id:
-        await safe_send(context.bot, chat_id,
-                        f"Hey, just a quick note!"
-                        f"🔄 Ваше занятие {data['day']} в {data['time']} перенесено на "
-                        f"{data['new_day']} в {data['new_time']}.")
+        broadcaster.submit(chat_id,
+                           f"Hey, just a quick note!"
+                           f"🔄 Ваше занятие {data['day']} в {data['time']} перенесено на "
+                           f"{data['new_day']} в {data['new_time']}.")
 
 async def move_schedule_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["mode"] = "move"
+    set_chat_mode(update, context, "move")
     await update.message.reply_text(
         """Введите данные для переноса занятия в формате:
 
 ИмяПользователя
 {"day": "Понедельник", "time": "10:00", "new_day": "Вторник", "new_time": "11:30"}
 
+Переносится только ближайшее такое занятие, следующие недели идут по обычному расписанию.
 Убедитесь, что день и время точно совпадают с текущим расписанием."""
     )
     return
 
 async def edit_schedule_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global admin_edit_mode
-    admin_edit_mode = True
     await update.message.reply_text(
-        """Введите имя ученика и новое занятие в формате:
+        """Введите имя ученика и разовое занятие на ближайшую неделю в формате:
 
 ИмяПользователя
 {"day": "Понедельник", "time": "10:00", "description": "Тема"}
 
 Пример:
 RuslanAlmasovich
-{"day": "Среда", "time": "13:00", "description": "Физика"}"""
+{"day": "Среда", "time": "13:00", "description": "Физика"}
+
+Постоянные изменения вносятся через массовый импорт."""
     )
 
     return
 
 async def delete_schedule_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
-        """Введите имя пользователя и данные урока для удаления:
+        """Введите имя пользователя и данные урока для отмены на ближайшей неделе:
 
 ИмяПользователя
 {"day": "Понедельник", "time": "10:00"}
@@ -345,7 +1800,6 @@ async def delete_schedule_prompt(update: Update, context: ContextTypes.DEFAULT_T
 RuslanAlmasovich
 {"day": "Среда", "time": "13:00"}"""
     )
-    context.user_data["awaiting_deletion"] = True
 
 async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != ADMIN_ID:
@@ -363,39 +1817,43 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         new_lesson = json.loads(json_str)
 
         # 🚀 Валидация day и time:
-        days = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
-        if new_lesson["day"] not in days:
+        if new_lesson["day"] not in DAYS:
             await update.message.reply_text("Ошибка: некорректный день недели.")
             return
 
         try:
-            datetime.strptime(new_lesson["time"], "%H:%M")
+            slot = parse_slot(new_lesson["day"], new_lesson["time"])
         except ValueError:
             await update.message.reply_text("Ошибка: некорректное время. Формат HH:MM.")
             return
 
-        # 🚀 Добавляем новое занятие
-        if user_name not in temporary_schedule:
-            await update.message.reply_text("Пользователь не найден.")
-            return
+        async with locked_students(user_name):
+            # 🚀 Добавляем новое занятие
+            if user_name not in temporary_schedule:
+                await update.message.reply_text("Пользователь не найден.")
+                return
 
-        temporary_schedule[user_name]["schedule"].append(new_lesson)
+            # 🚀 Проверяем накладки в ту дату, на которую ляжет занятие
+            date = occurrence_date(slot, student_now(user_name))
+            own, others = slot_conflicts(user_name, slot, date=date)
+            if own:
+                await update.message.reply_text(f"❗ У {user_name} уже есть занятие в это время.")
+                return
 
-        # 🚀 Сохраняем в файл
-        with open("users.json", "w", encoding="utf-8") as f:
-            json.dump(temporary_schedule, f, ensure_ascii=False, indent=4)
+            # 🚀 Сохраняем в журнал
+            commit_schedule_change({"op": "add", "user": user_name, "date": date.isoformat(), "lesson": new_lesson})
 
         # 🚀 Подтверждение админу
-        await update.message.reply_text(f"Новое занятие добавлено для {user_name}.")
+        await update.message.reply_text(f"Разовое занятие {date:%d.%m} добавлено для {user_name}.{conflict_warning(others)}")
 
         # 🚀 Уведомление ученику
         chat_id = user_data.get(user_name)
         if chat_id:
             text = (
                 f"📅 Новое занятие добавлено!\n\n"
-                f"{new_lesson['day']} в {new_lesson['time']} – {new_lesson.get('description', '')}"
+                f"{new_lesson['day']} {date:%d.%m} в {new_lesson['time']} – {new_lesson.get('description', '')}"
             )
-            await safe_send(context.bot, chat_id, text)
+            broadcaster.submit(chat_id, text)
 
     except json.JSONDecodeError:
         await update.message.reply_text("Ошибка: JSON некорректен.")
@@ -415,53 +1873,234 @@ async def handle_delete_input(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_name = user_name.strip()
 
     try:
-        to_delete = json.loads(json_str)
-        if user_name not in temporary_schedule:
-            await update.message.reply_text("Пользователь не найден.")
-            return
+        async with locked_students(user_name):
+            to_delete = json.loads(json_str)
+            if user_name not in temporary_schedule:
+                await update.message.reply_text("Пользователь не найден.")
+                return
 
-        # Удаляем урок, если совпадает day и time
-        schedule = temporary_schedule[user_name]["schedule"]
-        updated_schedule = [
-            lesson for lesson in schedule
-            if not (lesson["day"] == to_delete["day"] and lesson["time"] == to_delete["time"])
-        ]
-
-        if len(updated_schedule) == len(schedule):
-            await update.message.reply_text("Урок с такими параметрами не найден.")
-            return
+            # Отменяем ближайшее занятие, если совпадает day и time
+            lesson, date = find_week_lesson(user_name, parse_slot(to_delete["day"], to_delete["time"]))
+            if lesson is None:
+                await update.message.reply_text("Урок с такими параметрами не найден.")
+                return
 
-        temporary_schedule[user_name]["schedule"] = updated_schedule
+            # Записываем правку в журнал
+            commit_schedule_change({"op": "delete", "user": user_name, "day": to_delete["day"], "time": to_delete["time"],
+                                    "date": date.isoformat()})
 
-        # Обновляем файл
-        with open("users.json", "w", encoding="utf-8") as f:
-            json.dump(temporary_schedule, f, ensure_ascii=False, indent=4)
-
-        await update.message.reply_text(f"Урок удалён у пользователя {user_name}.")
+        await update.message.reply_text(f"Урок {date:%d.%m} отменён у пользователя {user_name}.")
 
         # Уведомление ученику
         chat_id = user_data.get(user_name)
         if chat_id:
-            await safe_send(context.bot, chat_id, f"Greetings! 👋 Подтверждаем отмену занятия {to_delete['day']} {to_delete['time']}")
+            broadcaster.submit(chat_id, f"Greetings! 👋 Подтверждаем отмену занятия {to_delete['day']} {date:%d.%m} {to_delete['time']}")
 
     except Exception as e:
         await update.message.reply_text(f"Ошибка: {e}")
 
+def bump_schedule_version():
+    global schedule_version
+    schedule_version += 1
+    render_cache.clear()
+
+def split_pages(blocks, separator="\n\n"):
+    """Склеивает блоки в страницы не длиннее MESSAGE_LIMIT, не разрывая блоки без нужды."""
+    pages, current = [], ""
+    for block in blocks:
+        while len(block) > MESSAGE_LIMIT:
+            # Блок сам не влезает в сообщение — режем его по строкам
+            cut = block.rfind("\n", 0, MESSAGE_LIMIT)
+            cut = cut if cut > 0 else MESSAGE_LIMIT
+            if current:
+                pages.append(current)
+                current = ""
+            pages.append(block[:cut])
+            block = block[cut:].lstrip("\n")
+        if current and len(current) + len(separator) + len(block) > MESSAGE_LIMIT:
+            pages.append(current)
+            current = ""
+        current = f"{current}{separator}{block}" if current else block
+    if current:
+        pages.append(current)
+    return pages
+
+def format_lessons(lessons):
+    return "\n".join([f"{l['day']} {l['time']} - {l.get('description','')}" for l in lessons])
+
+def week_view(user_name):
+    """Ближайшая неделя ученика с учётом разовых правок — в формате уроков users.json."""
+    return [
+        {"day": l.day, "time": l.time,
+         "description": f"{l.description} (разово {l.date:%d.%m})" if l.date else l.description}
+        for l in week_lessons(user_name)
+    ]
+
+def rendered_pages(what, user=None):
+    # Неделя сдвигается каждый день, а день у учеников в разных поясах наступает в разное время
+    if what == "all":
+        today = tuple(clock.now(ZoneInfo(zone)).date() for zone in schedule_zones())
+    else:
+        today = student_now(user).date()
+    cached = render_cache.get((what, user))
+    if cached and cached[0] == schedule_version and cached[1] == today:
+        return cached[2]
+    if what == "all":
+        schedule = schedule_snapshot()
+        pages = split_pages([
+            f"{u}{'' if user_tz.get(u, DEFAULT_TZ) == DEFAULT_TZ else f' ({user_tz[u]})'}:\n{format_lessons(week_view(u))}"
+            for u in schedule
+        ])
+    else:
+        pages = split_pages(format_lessons(week_view(user)).split("\n"), "\n")
+    render_cache[(what, user)] = (schedule_version, today, pages)
+    return pages
+
+def pager_markup(page, total):
+    if total <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀", callback_data=f"all:{page - 1}"))
+    buttons.append(InlineKeyboardButton(f"{page + 1}/{total}", callback_data=f"all:{page}"))
+    if page < total - 1:
+        buttons.append(InlineKeyboardButton("▶", callback_data=f"all:{page + 1}"))
+    return InlineKeyboardMarkup([buttons])
+
+async def bulk_schedule_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        """Отправьте новое расписание сразу для нескольких учеников.
+
+JSON — ученик и полный список его занятий:
+{"RuslanAlmasovich": [{"day": "Среда", "time": "13:00", "description": "Физика"}]}
+
+или CSV — по строке на занятие:
+RuslanAlmasovich,Среда,13:00,Физика
+
+Расписание каждого упомянутого ученика заменяется целиком, остальные не меняются."""
+    )
+
+def parse_bulk_schedule(text):
+    """Разбирает JSON или CSV в {ученик: [уроки]}; возвращает (расписания, ошибки)."""
+    text = text.strip()
+    if text.startswith("{"):
+        try:
+            raw = json.loads(text)
+        except json.JSONDecodeError as e:
+            return {}, [f"JSON некорректен: {e}"]
+        rows = [
+            (user, lesson) for user, lessons in raw.items()
+            for lesson in (lessons if isinstance(lessons, list) else [lessons])
+        ]
+        schedules = {user: [] for user in raw}
+    else:
+        rows, schedules = [], {}
+        import csv
+        import io
+        for fields in csv.reader(io.StringIO(text)):
+            if not fields or fields[0].strip().lower() in ("", "user", "ученик"):
+                continue
+            fields = [f.strip() for f in fields] + [""] * 4
+            user, day, time_str, description = fields[:4]
+            schedules.setdefault(user, [])
+            rows.append((user, {"day": day, "time": time_str, "description": description}))
+
+    errors = [f"{user}: ученик не найден" for user in schedules if user not in temporary_schedule]
+    seen = set()
+    for user, lesson in rows:
+        if user not in temporary_schedule:
+            continue
+        if not isinstance(lesson, dict):
+            errors.append(f"{user}: занятие должно быть объектом")
+            continue
+        try:
+            slot = parse_slot(lesson.get("day"), lesson.get("time"))
+        except ValueError as e:
+            errors.append(f"{user}: {lesson} — {e}")
+            continue
+        if (user, slot) in seen:
+            errors.append(f"{user}: два занятия в {lesson['day']} {lesson['time']}")
+            continue
+        seen.add((user, slot))
+        schedules[user].append({"day": lesson["day"], "time": lesson["time"], "description": lesson.get("description", "")})
+    return schedules, errors
+
+def diff_schedule(user_name, new_lessons):
+    """Сравнивает занятия по слотам: (добавленные, удалённые, изменённые)."""
+    old = {lesson_slot(l): l for l in temporary_schedule[user_name]["schedule"]}
+    new = {lesson_slot(l): l for l in new_lessons}
+    added = [new[s] for s in new if s not in old]
+    removed = [old[s] for s in old if s not in new]
+    changed = [new[s] for s in new if s in old and old[s].get("description", "") != new[s].get("description", "")]
+    return added, removed, changed
+
+def format_diff(added, removed, changed):
+    lines = [f"➕ {l['day']} {l['time']} – {l.get('description', '')}" for l in added]
+    lines += [f"➖ {l['day']} {l['time']}" for l in removed]
+    lines += [f"✏️ {l['day']} {l['time']} – {l.get('description', '')}" for l in changed]
+    return "\n".join(lines)
+
+async def handle_bulk_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id != ADMIN_ID:
+        return
+
+    schedules, errors = parse_bulk_schedule(update.message.text)
+    if errors:
+        for page in split_pages(["Импорт отменён, ничего не изменено:"] + errors, "\n"):
+            await update.message.reply_text(page)
+        return
+
+    async with locked_students(*schedules):
+        diffs = {}
+        for user_name, lessons in schedules.items():
+            added, removed, changed = diff_schedule(user_name, lessons)
+            if added or removed or changed:
+                diffs[user_name] = (added, removed, changed)
+        if not diffs:
+            await update.message.reply_text("Изменений нет.")
+            return
+
+        # Все правки — одной записью журнала
+        commit_schedule_change({"op": "replace", "users": {u: schedules[u] for u in diffs}})
+
+    report = [f"{u}:\n{format_diff(*d)}" for u, d in diffs.items()]
+    for page in split_pages([f"✅ Обновлено учеников: {len(diffs)}"] + report):
+        await update.message.reply_text(page)
+
+    # Каждому ученику — одно сводное уведомление
+    for user_name, diff in diffs.items():
+        chat_id = user_data.get(user_name)
+        if not chat_id:
+            continue
+        broadcaster.submit(chat_id, f"📅 Ваше расписание обновлено:\n\n{format_diff(*diff)}")
+
 async def show_my_schedule(update: Update):
     user = update.effective_chat.username
-    data = temporary_schedule.get(user)
-    if not data:
+    data = schedule_snapshot().get(user)
+    if not data or not data['schedule']:
         await update.message.reply_text("Нет расписания.")
         return
-    text = "\n".join([f"{l['day']} {l['time']} - {l.get('description','')}" for l in data['schedule']])
-    await update.message.reply_text(text)
+    for page in rendered_pages("user", user):
+        await update.message.reply_text(page)
 
 async def show_all(update: Update):
-    text = []
-    for user, data in temporary_schedule.items():
-        lessons = "\n".join([f"{l['day']} {l['time']} - {l.get('description','')}" for l in data['schedule']])
-        text.append(f"{user}:\n{lessons}")
-    await update.message.reply_text("\n\n".join(text))
+    pages = rendered_pages("all")
+    if not pages:
+        await update.message.reply_text("Расписание пусто.")
+        return
+    await update.message.reply_text(pages[0], reply_markup=pager_markup(0, len(pages)))
+
+async def show_all_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листание «Все расписания» кнопками под сообщением."""
+    query = update.callback_query
+    if update.effective_chat.id != ADMIN_ID:
+        await query.answer()
+        return
+    pages = rendered_pages("all") or ["Расписание пусто."]
+    page = min(int(query.data.split(":")[1]), len(pages) - 1)
+    await query.answer()
+    if query.message.text != pages[page]:
+        await query.edit_message_text(pages[page], reply_markup=pager_markup(page, len(pages)))
 
 async def show_users(update: Update):
     if not user_data:
@@ -484,52 +2123,289 @@ async def delete_lesson(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         user_name, day, time = [line.strip() for line in lines]
 
-        if user_name not in temporary_schedule:
-            await update.message.reply_text("Пользователь не найден.")
-            return
-
-        schedule = temporary_schedule[user_name]["schedule"]
-        new_schedule = [l for l in schedule if not (l['day'] == day and l['time'] == time)]
+        async with locked_students(user_name):
+            if user_name not in temporary_schedule:
+                await update.message.reply_text("Пользователь не найден.")
+                return
 
-        if len(schedule) == len(new_schedule):
-            await update.message.reply_text("Занятие не найдено.")
-            return
+            try:
+                slot = parse_slot(day, time)
+            except ValueError as e:
+                await update.message.reply_text(f"Ошибка: {e}")
+                return
+            lesson, date = find_week_lesson(user_name, slot)
+            if lesson is None:
+                await update.message.reply_text("Занятие не найдено.")
+                return
 
-        temporary_schedule[user_name]["schedule"] = new_schedule
+            commit_schedule_change({"op": "delete", "user": user_name, "day": day, "time": time, "date": date.isoformat()})
 
-        with open("users.json", "w", encoding="utf-8") as f:
-            json.dump(temporary_schedule, f, ensure_ascii=False, indent=4)
-
-        await update.message.reply_text(f"Занятие {day} {time} удалено у пользователя {user_name}.")
+        await update.message.reply_text(f"Занятие {day} {date:%d.%m} {time} отменено у пользователя {user_name}.")
 
         chat_id = user_data.get(user_name)
         if chat_id:
-            await safe_send(context.bot, chat_id, f"❌ Занятие в {day} {time} было удалено из вашего расписания.")
+            broadcaster.submit(chat_id, f"❌ Занятие в {day} {date:%d.%m} {time} отменено.")
 
     except Exception as e:
         await update.message.reply_text(f"[ERROR] {e}")
 
+def timed_job(name, job):
+    # Обычную функцию AsyncIOScheduler запустил бы в пуле потоков, а куча напоминаний
+    # и reminder_wakeup живут только в event loop
+    if not asyncio.iscoroutinefunction(job):
+        raise TypeError(f"Фоновая задача {name} должна быть корутиной")
+
+    async def run():
+        with metrics.timer("job_seconds", job=name):
+            await job()
+    return run
+
 def schedule_jobs(app):
+    # Планировщик нужен только для фоновых задач — не тратим на него время до первого напоминания
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    from apscheduler.triggers.cron import CronTrigger
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(update_user_data, "interval", minutes=5)
-    scheduler.add_job(clean_sent_reminders, CronTrigger(hour=0))
-    scheduler.add_job(send_reminders_24h, "interval", minutes=15, args=[app])
-    scheduler.add_job(send_reminders_1h, "interval", minutes=5, args=[app])
-    scheduler.add_job(reset_schedule_to_default, CronTrigger(day_of_week='sun', hour=19, minute=00))
+    scheduler.add_job(timed_job("update_user_data", update_user_data), "interval", minutes=5)
+    scheduler.add_job(timed_job("clean_sent_reminders", clean_sent_reminders), CronTrigger(hour=0))
+    scheduler.add_job(timed_job("expire_overlay", expire_overlay), CronTrigger(hour=0, minute=1))
+    if CLUSTER_DB:
+        scheduler.add_job(timed_job("cluster_heartbeat", cluster_heartbeat), "interval", seconds=CLUSTER_HEARTBEAT)
+    if SYNC_URL:
+        scheduler.add_job(timed_job("sync_remote_schedule", sync_remote_schedule), "interval", seconds=SYNC_INTERVAL)
+    if WATCH_INTERVAL:
+        scheduler.add_job(timed_job("watch_schedule_file", watch_schedule_file), "interval", seconds=WATCH_INTERVAL)
 
     scheduler.start()
 
-def main():
-    load_default_schedule()
-    load_user_data()
-    app = Application.builder().token(BOT_TOKEN).build()
+async def serve_http(host, port, routes):
+    """Минимальный HTTP/1.1-сервер на asyncio: routes[(метод, путь)] -> async handler(body, headers)."""
+
+    async def read_request(reader):
+        request_line = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        for _ in range(HTTP_MAX_HEADERS + 1):
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ValueError("слишком много заголовков")
+        length = int(headers.get("content-length", 0))
+        if not 0 <= length <= HTTP_MAX_BODY:
+            return request_line, headers, None
+        return request_line, headers, await reader.readexactly(length)
+
+    async def handle(reader, writer):
+        try:
+            # Зависший клиент не должен держать соединение: при остановке его ждёт wait_closed()
+            try:
+                request_line, headers, body = await asyncio.wait_for(read_request(reader), HTTP_READ_TIMEOUT)
+            except asyncio.TimeoutError:
+                status, content_type, payload = 408, "text/plain", b"timeout"
+            except ValueError as e:
+                # Нечисловой Content-Length, слишком длинная строка или слишком много заголовков
+                print(f"[WARN] Некорректный HTTP-запрос: {e}")
+                status, content_type, payload = 400, "text/plain", b"bad request"
+            else:
+                method, path = (request_line + ["", ""])[:2]
+                handler = routes.get((method, path.split("?")[0]))
+                if body is None:
+                    status, content_type, payload = 413, "text/plain", b"too large"
+                elif handler is None:
+                    status, content_type, payload = 404, "text/plain", b"not found"
+                else:
+                    status, content_type, payload = await handler(body, headers)
+            writer.write(
+                f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}\r\n"
+                f"Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n"
+                f"Connection: close\r\n\r\n".encode("latin-1") + payload
+            )
+            await asyncio.wait_for(writer.drain(), HTTP_READ_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError) as e:
+            print(f"[WARN] Некорректный HTTP-запрос: {e!r}")
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+async def metrics_endpoint(body, headers):
+    return 200, "text/plain; version=0.0.4", metrics.render().encode("utf-8")
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id != ADMIN_ID:
+        await update.message.reply_text("У вас нет прав для выполнения этой команды.")
+        return
+    await update.message.reply_text(
+        f"📊 Напоминаний в очереди: {len(reminder_heap)}\n"
+        f"Сообщений в очереди отправки: {broadcaster.queue.qsize() if broadcaster else 0}\n"
+        f"В outbox: {sent_db.execute('SELECT COUNT(*) FROM outbox WHERE dead = 0').fetchone()[0]}, "
+        f"недоставлено: {sent_db.execute('SELECT COUNT(*) FROM outbox WHERE dead = 1').fetchone()[0]}\n\n"
+        f"{metrics.summary()}"[:4096]
+    )
+
+def webhook_routes(app, secret):
+    import hmac
+
+    async def receive_update(body, headers):
+        # chat_id в апдейте — единственная проверка прав админа, поэтому без секрета не принимаем ничего
+        token = headers.get("x-telegram-bot-api-secret-token", "").encode("latin-1")
+        if not hmac.compare_digest(token, secret.encode("utf-8")):
+            metrics.inc("webhook_rejected_total", reason="secret")
+            return 401, "text/plain", b"bad secret"
+        if not app.running:
+            return 503, "text/plain", b"shutting down"
+        try:
+            data = json.loads(body)
+            # de_json возвращает None для пустых данных — такой апдейт в очередь класть нельзя
+            update = Update.de_json(data, app.bot) if isinstance(data, dict) else None
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            print(f"[WARN] Некорректный update: {e}")
+            update = None
+        if update is None:
+            metrics.inc("webhook_rejected_total", reason="payload")
+            return 400, "text/plain", b"bad update"
+        await app.update_queue.put(update)
+        metrics.inc("webhook_updates_total")
+        return 200, "text/plain", b"ok"
+
+    async def health(body, headers):
+        task = app.bot_data.get("reminder_task")
+        healthy = app.running and task is not None and not task.done()
+        payload = {"status": "ok" if healthy else "down", "reminders": len(reminder_heap),
+                   "pending_updates": app.update_queue.qsize()}
+        return (200 if healthy else 503), "application/json", json.dumps(payload).encode("utf-8")
+
+    return {("POST", WEBHOOK_PATH): receive_update, ("GET", "/health"): health}
+
+async def run_without_polling(app, start_server=None):
+    """Запуск без long polling; start_server() поднимает приём обновлений, если он нужен.
+
+    При SIGTERM/SIGINT сервер перестаёт принимать соединения, дожидается уже
+    начатых запросов, после чего приложение дообрабатывает очередь обновлений.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await app.initialize()
+    await on_startup(app)
     schedule_jobs(app)
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, button_handler))
-    app.add_handler(CommandHandler("test_reminders", test_reminders))
-    app.add_handler(CommandHandler("delete_lesson", delete_lesson))
-    app.add_handler(CommandHandler("move_lesson", move_schedule_prompt))
+    await app.start()
+    server = await start_server() if start_server else None
+
+    await stop_event.wait()
+    print("[INFO] Остановка: дожидаемся обработки входящих обновлений...")
+    if server:
+        server.close()
+        try:
+            # В Python 3.12 wait_closed() ждёт и открытые соединения — не даём им задержать сохранение состояния
+            await asyncio.wait_for(server.wait_closed(), HTTP_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("[WARN] Не все HTTP-соединения закрылись, продолжаем остановку")
+    await app.stop()
+    await on_shutdown(app)
+    await app.shutdown()
+
+async def run_webhook(app):
+    """Обновления приходят POST-запросами от Telegram — так их можно раздать на несколько воркеров."""
+    secret = WEBHOOK_SECRET
+    if not secret:
+        if not WEBHOOK_URL:
+            raise RuntimeError("В режиме webhook нужен WEBHOOK_SECRET или WEBHOOK_URL, чтобы бот сам зарегистрировал секрет")
+        import secrets
+        secret = secrets.token_urlsafe(32)
+
+    async def start_server():
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(WEBHOOK_URL, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+        server = await serve_http(WEBHOOK_HOST, WEBHOOK_PORT, webhook_routes(app, secret))
+        print(f"Бот запущен в режиме webhook на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        return server
+
+    await run_without_polling(app, start_server)
+
+async def on_startup(app):
+    global broadcaster
+    # Цикл напоминаний и рассылка живут в том же event loop, что и бот
+    if CLUSTER_DB:
+        await cluster_heartbeat()
+    broadcaster = Broadcaster(app.bot)
+    broadcaster.replay(startup=True)
+    app.bot_data["reminder_task"] = asyncio.create_task(reminder_loop(app))
+    if state_cache_dirty:
+        mark_state_dirty()
+    if METRICS_PORT:
+        app.bot_data["metrics_server"] = await serve_http(METRICS_HOST, METRICS_PORT, {("GET", "/metrics"): metrics_endpoint})
+        print(f"[INFO] Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def on_shutdown(app):
+    app.bot_data["reminder_task"].cancel()
+    if CLUSTER_DB:
+        # Освобождаем шард сразу, не дожидаясь истечения аренды
+        sent_db.execute("DELETE FROM workers WHERE id = ?", (WORKER_ID,))
+        sent_db.execute("DELETE FROM poller WHERE worker = ?", (WORKER_ID,))
+    if "metrics_server" in app.bot_data:
+        app.bot_data["metrics_server"].close()
+    if broadcaster:
+        await broadcaster.stop()
+    if user_data_flush_task:
+        user_data_flush_task.cancel()
+    # Начатая фоновая запись должна закончиться раньше финальной, иначе перезапишет её старыми данными
+    if user_data_write and not user_data_write.done():
+        await asyncio.wait([user_data_write])
+    if user_data_dirty or (user_data_write and user_data_write.exception()):
+        save_user_data()
+    if state_cache_task:
+        state_cache_task.cancel()
+    if state_cache_write and not state_cache_write.done():
+        await asyncio.wait([state_cache_write])
+    if compaction_task:
+        await compaction_task
+    save_state_cache()
 
+def main():
+    global cluster_poller
+    if BOT_MODE not in ("polling", "webhook", "worker"):
+        raise RuntimeError(f"Неизвестный BOT_MODE: {BOT_MODE}")
+    if os.path.exists("default_users.json"):
+        # Раньше расписание раз в неделю сбрасывалось к этому файлу; теперь база — users.json
+        print(f"[WARN] default_users.json больше не используется, постоянное расписание берётся из {SCHEDULE_FILE}")
+    state = read_state_cache()
+    with journal_lock():
+        load_default_schedule(state)
+    load_user_data(state)
+    open_sent_store(CLUSTER_DB or SENT_DB, state)
+    if CLUSTER_DB:
+        open_cluster()
+        if BOT_MODE == "polling":
+            # getUpdates может читать только один процесс; остальные воркеры запускают с BOT_MODE=worker
+            if not claim_poller():
+                raise RuntimeError("getUpdates уже опрашивает другой воркер кластера: "
+                                   "запустите этот с BOT_MODE=worker или переведите кластер на BOT_MODE=webhook")
+            cluster_poller = True
+    # Разные чаты обрабатываются параллельно, порядок внутри чата сохраняет per_chat
+    app = (
+        Application.builder().token(BOT_TOKEN).concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_startup).post_shutdown(on_shutdown).build()
+    )
+    app.add_handler(CommandHandler("start", per_chat(start)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, per_chat(button_handler)))
+    app.add_handler(CommandHandler("test_reminders", per_chat(test_reminders)))
+    app.add_handler(CommandHandler("delete_lesson", per_chat(delete_lesson)))
+    app.add_handler(CommandHandler("move_lesson", per_chat(move_schedule_prompt)))
+    app.add_handler(CommandHandler("stats", per_chat(stats)))
+    app.add_handler(CallbackQueryHandler(per_chat(show_all_page), pattern=r"^all:\d+$"))
+
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(app))
+        return
+    if BOT_MODE == "worker":
+        print("Бот запущен в режиме worker: только напоминания и рассылка")
+        asyncio.run(run_without_polling(app))
+        return
+    schedule_jobs(app)
     print("Бот запущен...")
     app.run_polling()
 
@@ -0,0 +1,168 @@
+"""Симуляция напоминаний на виртуальных часах.
+
+Запуск:
+    python simulate.py --days 7 --output week.json
+    python simulate.py --students 10000 --days 14 --summary-only
+    python simulate.py --roster users.json --changes changes.jsonl --tick-delay 30
+
+Бот загружает расписание во временном каталоге, часы подменяются
+виртуальными, и цикл тиков перескакивает от одного напоминания к другому,
+так что неделя проходит за секунды. Ночные задачи (очистка журнала
+отправленных и истечение разовых правок) выполняются в полночь виртуального
+времени. Поддельный Bot принимает сообщения, а каждое событие напоминания —
+отправлено, пропущено, дубль, отменено, нет чата — попадает в отчёт с
+виртуальным временем и опозданием.
+
+Файл --changes — JSON Lines с полями "at" (ISO-время в поясе бота) и
+"record" (правка в формате журнала users.journal); правки применяются через
+commit_schedule_change в указанный момент.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import napominanie as bot
+from benchmark import FakeApp, FakeBot, generate_roster
+
+
+class VirtualClock(bot.Clock):
+    def __init__(self, start):
+        self.current = start
+
+    def time(self):
+        return self.current
+
+    def now(self, tz=None):
+        return datetime.fromtimestamp(self.current, tz or bot.local_tz)
+
+
+def load_changes(path):
+    changes = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                change = json.loads(line)
+                at = datetime.fromisoformat(change["at"])
+                if at.tzinfo is None:
+                    at = at.replace(tzinfo=bot.local_tz)
+                changes.append((at.timestamp(), change["record"]))
+    return sorted(changes, key=lambda c: c[0])
+
+
+def iso(ts):
+    return datetime.fromtimestamp(ts, bot.local_tz).isoformat(timespec="seconds")
+
+
+async def simulate(args, start, changes):
+    clock = bot.clock = VirtualClock(start)
+    end = start + args.days * 86400
+    events = []
+
+    def observe(event, user_name, kind, lesson_at, now):
+        fire_at = lesson_at - bot.REMINDER_OFFSETS[kind]
+        events.append({
+            "event": event, "user": user_name, "kind": kind,
+            "at": iso(now), "lesson": iso(lesson_at), "lateness_s": round(now - fire_at, 3),
+        })
+
+    bot.reminder_observer = observe
+    bot.load_default_schedule()
+    bot.open_sent_store(os.path.join(os.getcwd(), "sent.db"))
+    bot.user_data = {user: 1000 + i for i, user in enumerate(bot.temporary_schedule)}
+    bot.rate_limiter = bot.RateLimiter(rate=10 ** 9, per_chat_interval=0)
+    bot.broadcaster = None  # сообщения уходят в поддельный Bot прямо из тика
+    fake_bot = FakeBot()
+    app = FakeApp(fake_bot)
+
+    started = time.perf_counter()
+    bot.rebuild_reminders()
+    midnight = clock.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    next_daily = midnight.timestamp()
+    ticks = 0
+    while True:
+        due = bot.reminder_heap[0][0] + args.tick_delay if bot.reminder_heap else float("inf")
+        next_change = changes[0][0] if changes else float("inf")
+        moment = min(due, next_daily, next_change)
+        if moment > end:
+            break
+        clock.current = max(clock.current, moment)
+        while changes and changes[0][0] <= clock.current:
+            bot.commit_schedule_change(changes.pop(0)[1])
+        if next_daily <= clock.current:
+            await bot.clean_sent_reminders()
+            await bot.expire_overlay()
+            next_daily += 86400
+        await bot.fire_due_reminders(app)
+        ticks += 1
+    wall = time.perf_counter() - started
+    bot.sent_db.close()
+
+    summary = {}
+    for event in events:
+        key = f"{event['event']}_{event['kind']}"
+        summary[key] = summary.get(key, 0) + 1
+    late = [e["lateness_s"] for e in events if e["event"] == "sent"]
+    return {
+        "start": iso(start),
+        "end": iso(end),
+        "students": len(bot.temporary_schedule),
+        "ticks": ticks,
+        "wall_s": wall,
+        "messages": fake_bot.sent,
+        "summary": summary,
+        "max_lateness_s": max(late, default=0),
+        "events": [] if args.summary_only else events,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--roster", help="users.json для симуляции (по умолчанию users.json рядом со скриптом)")
+    parser.add_argument("--students", type=int, help="вместо --roster сгенерировать столько учеников")
+    parser.add_argument("--start", help="начало в ISO-формате, по умолчанию — сейчас")
+    parser.add_argument("--days", type=float, default=7)
+    parser.add_argument("--tick-delay", type=float, default=0.0, help="на сколько секунд тик опаздывает к каждому напоминанию")
+    parser.add_argument("--changes", help="JSON Lines с правками расписания по ходу симуляции")
+    parser.add_argument("--summary-only", action="store_true", help="не включать в отчёт список событий")
+    parser.add_argument("--output", help="куда записать JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    start = datetime.fromisoformat(args.start) if args.start else datetime.now(bot.local_tz)
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=bot.local_tz)
+    changes = load_changes(args.changes) if args.changes else []
+    roster = os.path.abspath(args.roster or os.path.join(os.path.dirname(os.path.abspath(__file__)), "users.json"))
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            if args.students:
+                with open(bot.SCHEDULE_FILE, "w", encoding="utf-8") as f:
+                    json.dump(generate_roster(args.students), f, ensure_ascii=False)
+            else:
+                shutil.copy(roster, bot.SCHEDULE_FILE)
+            bot.STATE_CACHE = ""  # снимок состояния симуляции не нужен
+            # Служебный вывод бота уводим в stderr, чтобы не смешивать с JSON
+            with contextlib.redirect_stdout(sys.stderr):
+                report = asyncio.run(simulate(args, start.timestamp(), changes))
+        finally:
+            os.chdir(cwd)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
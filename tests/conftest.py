@@ -0,0 +1,39 @@
+import importlib.util
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def load_bot(tmp_path, monkeypatch):
+    """Фабрика независимых экземпляров napominanie — по одному на воркер.
+
+    Все экземпляры работают в одном временном каталоге, как процессы
+    кластера на одной машине.
+    """
+    monkeypatch.chdir(tmp_path)
+    modules = []
+
+    def load(name, roster=None, **settings):
+        if roster is not None:
+            with open("users.json", "w", encoding="utf-8") as f:
+                json.dump(roster, f, ensure_ascii=False)
+        spec = importlib.util.spec_from_file_location(f"napominanie_{name}", os.path.join(ROOT, "napominanie.py"))
+        bot = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(bot)
+        bot.STATE_CACHE = ""
+        bot.WORKER_ID = name
+        for key, value in settings.items():
+            setattr(bot, key, value)
+        modules.append(bot)
+        return bot
+
+    yield load
+    for bot in modules:
+        if bot.sent_db is not None:
+            bot.sent_db.close()
+        sys.modules.pop(bot.__name__, None)
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import os
+
+ROSTER = {
+    "alice": {"schedule": [{"day": "Понедельник", "time": "10:00", "description": ""}]},
+    "bob": {"schedule": [{"day": "Вторник", "time": "10:00", "description": ""}]},
+}
+
+
+def start_worker(load_bot, name, **settings):
+    bot = load_bot(name, **settings)
+    bot.CLUSTER_DB = os.path.abspath("cluster.db")
+    with bot.journal_lock():
+        bot.load_default_schedule()
+    bot.load_user_data()
+    bot.open_sent_store(bot.CLUSTER_DB)
+    bot.open_cluster()
+    return bot
+
+
+def add_lesson(bot, time):
+    bot.commit_schedule_change({"op": "add", "user": "alice", "lesson": {"day": "Среда", "time": time, "description": ""}})
+
+
+def lesson_count(bot):
+    return sum(len(lessons) for lessons in bot.compiled_schedule.values())
+
+
+def test_follower_reloads_snapshot_after_leader_compacts(load_bot):
+    async def scenario():
+        leader = start_worker(load_bot, "a", roster=ROSTER, JOURNAL_COMPACT_EVERY=3)
+        follower = start_worker(load_bot, "b", JOURNAL_COMPACT_EVERY=3)
+        for bot in (leader, follower, leader):
+            await bot.cluster_heartbeat()
+        assert leader.is_leader() and not follower.is_leader()
+
+        for time in ("11:00", "12:00", "13:00"):
+            add_lesson(leader, time)
+        await leader.compaction_task
+        assert not os.path.exists(leader.JOURNAL_FILE + ".old")
+        with open("users.json", encoding="utf-8") as f:
+            assert json.load(f)["_journal"]["seq"] == 3
+
+        await follower.cluster_heartbeat()
+        assert follower.journal_seq == leader.journal_seq == 3
+        assert lesson_count(follower) == lesson_count(leader) == 5
+        assert sorted(e[5] for e in follower.reminder_heap if e[2] == "alice" and
+                      e[3] == follower.reminder_generation["alice"]) == \
+            sorted(e[5] for e in leader.reminder_heap if e[2] == "alice" and e[3] == leader.reminder_generation["alice"])
+
+        # Правки после сжатия доходят через новый журнал поверх перечитанного снимка
+        add_lesson(leader, "14:00")
+        await follower.cluster_heartbeat()
+        assert follower.journal_seq == 4
+        assert lesson_count(follower) == 6
+
+    asyncio.run(scenario())
+
+
+def test_new_leader_does_not_compact_stale_schedule(load_bot):
+    async def scenario():
+        leader = start_worker(load_bot, "a", roster=ROSTER, JOURNAL_COMPACT_EVERY=3)
+        follower = start_worker(load_bot, "b", JOURNAL_COMPACT_EVERY=3)
+        for bot in (leader, follower, leader):
+            await bot.cluster_heartbeat()
+        for time in ("11:00", "12:00", "13:00"):
+            add_lesson(leader, time)
+        await leader.compaction_task
+
+        # Лидер уходит, follower становится лидером и сам сжимает журнал
+        leader.sent_db.execute("DELETE FROM workers WHERE id = ?", ("a",))
+        await follower.cluster_heartbeat()
+        assert follower.is_leader()
+        for time in ("15:00", "16:00", "17:00"):
+            add_lesson(follower, time)
+        await follower.compaction_task
+
+        with open("users.json", encoding="utf-8") as f:
+            snapshot = json.load(f)
+        assert snapshot["_journal"]["seq"] == 6
+        assert len(snapshot["alice"]["schedule"]) == 7
+
+    asyncio.run(scenario())
+
+
+def test_only_one_worker_polls_get_updates(load_bot):
+    first = start_worker(load_bot, "a", roster=ROSTER)
+    second = start_worker(load_bot, "b")
+    assert first.claim_poller()
+    assert not second.claim_poller()
+    assert first.claim_poller()
+
+    # Аренда зависшего воркера истекает, и опрос можно подхватить
+    first.sent_db.execute("UPDATE poller SET heartbeat = heartbeat - ?", (first.CLUSTER_LEASE + 1,))
+    assert second.claim_poller()
+    assert not first.claim_poller()
+
+
+def test_admin_input_mode_is_shared_between_workers(load_bot):
+    class Chat:
+        id = 42
+
+    class Update:
+        effective_chat = Chat()
+
+    class Context:
+        chat_data = {}
+
+    first = start_worker(load_bot, "a", roster=ROSTER)
+    second = start_worker(load_bot, "b")
+    first.set_chat_mode(Update(), Context(), "edit")
+    # Следующее сообщение админа балансировщик отдал другому воркеру
+    assert second.pop_chat_mode(Update(), Context()) == "edit"
+    assert first.pop_chat_mode(Update(), Context()) is None
@@ -0,0 +1,48 @@
+from datetime import date
+
+import pytest
+
+ROSTER = {
+    "moscow": {"schedule": [{"day": "Понедельник", "time": "23:45", "description": ""}]},
+    "newyork": {"tz": "America/New_York", "schedule": [{"day": "Понедельник", "time": "10:00", "description": ""}]},
+}
+MONDAY = date(2026, 10, 19)  # в Нью-Йорке ещё летнее время, UTC-4
+
+
+@pytest.fixture
+def bot(load_bot):
+    bot = load_bot("a", roster=ROSTER)
+    bot.load_default_schedule()
+    return bot
+
+
+def slot(bot, day, time):
+    return bot.parse_slot(day, time)
+
+
+def test_same_wall_clock_in_different_zones_is_not_a_conflict(bot):
+    assert bot.slot_conflicts("moscow", slot(bot, "Понедельник", "10:00"), date=MONDAY) == (False, [])
+
+
+def test_same_instant_in_different_zones_is_a_conflict(bot):
+    # 10:00 в Нью-Йорке — 17:00 в Москве
+    assert bot.slot_conflicts("moscow", slot(bot, "Понедельник", "17:30"), date=MONDAY) == (False, ["newyork"])
+
+
+def test_own_lesson_and_midnight_crossing(bot):
+    own, others = bot.slot_conflicts("moscow", slot(bot, "Вторник", "00:30"), date=date(2026, 10, 20))
+    assert own and others == []
+    assert bot.slot_conflicts("newyork", slot(bot, "Понедельник", "16:30"), date=MONDAY) == (False, ["moscow"])
+
+
+def test_one_off_lessons_are_compared_by_instant(bot):
+    bot.schedule_overlay["2026-10-20"] = {"newyork": {"cancel": [], "add": [
+        {"day": "Вторник", "time": "08:00", "description": ""}]}}
+    # 08:00 вторника в Нью-Йорке — 15:00 вторника в Москве
+    assert bot.slot_conflicts("moscow", slot(bot, "Вторник", "15:00"), date=date(2026, 10, 20)) == (False, ["newyork"])
+    assert bot.slot_conflicts("moscow", slot(bot, "Вторник", "08:00"), date=date(2026, 10, 20)) == (False, [])
+
+
+def test_cancelled_lesson_does_not_conflict(bot):
+    bot.schedule_overlay["2026-10-19"] = {"newyork": {"cancel": [10 * 60], "add": []}}
+    assert bot.slot_conflicts("moscow", slot(bot, "Понедельник", "17:00"), date=MONDAY) == (False, [])
@@ -0,0 +1,85 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+ROSTER = {
+    "alan": {"schedule": [{"day": "Понедельник", "time": "09:00", "description": "Английский у Алана"}]},
+    "daniel": {"schedule": [{"day": "Понедельник", "time": "14:00", "description": "Английский у Даниеля"}]},
+    "other": {"schedule": [{"day": "Понедельник", "time": "11:00", "description": ""}]},
+}
+PARENT_CHAT = 42
+
+
+class FakeBot:
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text):
+        self.messages.append((chat_id, text))
+
+
+class FakeApp:
+    def __init__(self):
+        self.bot = FakeBot()
+
+
+def at(bot, text):
+    return datetime.fromisoformat(text).replace(tzinfo=bot.local_tz).timestamp()
+
+
+def run_week(bot, moments):
+    """Прогоняет тики напоминаний в заданные моменты; возвращает отправленные сообщения."""
+    app = FakeApp()
+
+    async def scenario():
+        for moment in moments:
+            await bot.fire_due_reminders(app, at(bot, moment))
+
+    asyncio.run(scenario())
+    return app.bot.messages
+
+
+@pytest.fixture
+def bot(load_bot):
+    bot = load_bot("a", roster=ROSTER)
+    bot.load_default_schedule()
+    bot.open_sent_store("sent.db")
+    bot.user_data = {"alan": PARENT_CHAT, "daniel": PARENT_CHAT, "other": 7}
+    bot.rate_limiter = bot.RateLimiter(rate=10 ** 9, per_chat_interval=0)
+
+    class Clock(bot.Clock):
+        def time(self):
+            return at(bot, "2026-10-18T08:00:00")
+
+    bot.clock = Clock()
+    bot.rebuild_reminders()
+    return bot
+
+
+MOMENTS = ["2026-10-18T09:00:00", "2026-10-18T11:00:00", "2026-10-18T14:00:00",
+           "2026-10-19T08:00:00", "2026-10-19T10:00:00", "2026-10-19T13:00:00"]
+
+
+def test_day_digest_for_students_sharing_a_chat(bot):
+    messages = run_week(bot, MOMENTS)
+    parent = [text for chat_id, text in messages if chat_id == PARENT_CHAT]
+    # Один дайджест за день о понедельнике и два отдельных напоминания за час
+    assert len(parent) == 3
+    assert "09:00 – Английский у Алана" in parent[0] and "14:00 – Английский у Даниеля" in parent[0]
+    assert "в 09:00" in parent[1] and "в 14:00" in parent[2]
+    # Чужой чат дайджест не затрагивает
+    assert [chat_id for chat_id, _ in messages].count(7) == 2
+
+
+def test_day_digest_can_be_disabled(bot):
+    bot.DIGEST_BY_DAY = False
+    messages = run_week(bot, MOMENTS)
+    assert [chat_id for chat_id, _ in messages].count(PARENT_CHAT) == 4
+
+
+def test_digest_does_not_revive_missed_reminders(bot):
+    # Бот стартовал после 9:00: напоминание за день об уроке Алана уже просрочено
+    messages = run_week(bot, ["2026-10-18T14:00:00"])
+    parent = [text for chat_id, text in messages if chat_id == PARENT_CHAT]
+    assert len(parent) == 1 and "Алана" not in parent[0]
@@ -0,0 +1,77 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+LESSON = {"day": "Понедельник", "time": "10:00", "description": ""}
+
+
+class FakeBot:
+    async def send_message(self, chat_id, text):
+        pass
+
+
+class FakeApp:
+    def __init__(self):
+        self.bot = FakeBot()
+
+
+def at(bot, text):
+    return datetime.fromisoformat(text).replace(tzinfo=bot.local_tz).timestamp()
+
+
+def start_bot(load_bot, students):
+    bot = load_bot("a", roster={f"s{n}": {"schedule": [LESSON]} for n in range(students)})
+    bot.load_default_schedule()
+    bot.open_sent_store("sent.db")
+    bot.user_data = {f"s{n}": 1000 + n for n in range(students)}
+
+    class Clock(bot.Clock):
+        def time(self):
+            return at(bot, "2026-10-19T08:00:00")
+
+    bot.clock = Clock()
+    bot.rebuild_reminders()
+    return bot
+
+
+def count(bot, table):
+    return bot.sent_db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def test_cancelled_tick_leaves_no_claim_without_outbox_row(load_bot):
+    bot = start_bot(load_bot, 1200)
+
+    async def scenario():
+        # Без воркеров рассылки: проверяем только то, что легло в outbox
+        bot.broadcaster = bot.Broadcaster(FakeBot(), workers=0)
+        tick = asyncio.create_task(bot.fire_due_reminders(FakeApp(), at(bot, "2026-10-19T09:00:00")))
+        await asyncio.sleep(0)
+        tick.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await tick
+
+    asyncio.run(scenario())
+    assert 0 < count(bot, "sent") < 1200
+    assert count(bot, "sent") == count(bot, "outbox")
+
+
+def test_failed_tick_releases_claims_and_retries(load_bot):
+    bot = start_bot(load_bot, 3)
+    pull_digest_ahead = bot.pull_digest_ahead
+
+    def broken(batch, now):
+        raise RuntimeError("boom")
+
+    async def scenario():
+        bot.broadcaster = bot.Broadcaster(FakeBot(), workers=0)
+        bot.pull_digest_ahead = broken
+        with pytest.raises(RuntimeError):
+            await bot.fire_due_reminders(FakeApp(), at(bot, "2026-10-19T09:00:00"))
+        assert count(bot, "sent") == count(bot, "outbox") == 0
+
+        bot.pull_digest_ahead = pull_digest_ahead
+        await bot.fire_due_reminders(FakeApp(), at(bot, "2026-10-19T09:00:05"))
+
+    asyncio.run(scenario())
+    assert count(bot, "sent") == count(bot, "outbox") == 3
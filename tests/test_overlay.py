@@ -0,0 +1,18 @@
+from datetime import date
+
+ROSTER = {
+    "ny": {"tz": "America/New_York", "schedule": [{"day": "Понедельник", "time": "19:00", "description": ""}]},
+}
+
+
+def test_overlay_outlives_bot_midnight_for_western_students(load_bot):
+    bot = load_bot("a", roster=ROSTER)
+    bot.load_default_schedule()
+    # Отмена занятия в понедельник 19:00 по Нью-Йорку — это вторник 02:00 по Москве
+    bot.schedule_overlay["2026-10-19"] = {"ny": {"cancel": [19 * 60], "add": []}}
+    lesson = bot.compiled_schedule["ny"][0]
+    lesson_at = bot.local_timestamp("America/New_York", date(2026, 10, 19), 19 * 60)
+
+    assert bot.prune_overlay(date(2026, 10, 20)) == []
+    assert bot.reminder_cancelled("ny", lesson, lesson_at)
+    assert bot.prune_overlay(date(2026, 10, 21)) == ["2026-10-19"]
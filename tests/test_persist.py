@@ -0,0 +1,40 @@
+import os
+import threading
+from zoneinfo import ZoneInfo
+
+
+def test_concurrent_atomic_writes_do_not_collide(load_bot):
+    bot = load_bot("a")
+    payloads = [bytes([n]) * 65536 for n in range(2)]
+    errors = []
+
+    def writer(payload):
+        try:
+            for _ in range(50):
+                bot.write_bytes_atomic("state.bin", payload)
+        except Exception as e:
+            errors.append(e)
+
+    # Как фоновая запись снимка и финальное сохранение при остановке
+    threads = [threading.Thread(target=writer, args=(payload,)) for payload in payloads]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    with open("state.bin", "rb") as f:
+        assert f.read() in payloads
+    assert [name for name in os.listdir(".") if name.endswith(".tmp")] == []
+
+
+def test_state_cache_is_dropped_when_default_tz_changes(load_bot):
+    roster = {"alice": {"schedule": [{"day": "Понедельник", "time": "10:00", "description": ""}]},
+              "bob": {"schedule": [{"day": "Вторник", "time": "10:00", "description": ""}], "tz": "Asia/Dubai"}}
+    bot = load_bot("a", roster=roster, STATE_CACHE="state.bin")
+    bot.load_default_schedule()
+    bot.save_state_cache()
+
+    restarted = load_bot("b", STATE_CACHE="state.bin", DEFAULT_TZ="Asia/Tokyo", local_tz=ZoneInfo("Asia/Tokyo"))
+    restarted.load_default_schedule(restarted.read_state_cache())
+    assert restarted.user_tz == {"alice": "Asia/Tokyo", "bob": "Asia/Dubai"}
@@ -0,0 +1,48 @@
+import asyncio
+import os
+import time
+
+
+def test_retry_after_pauses_every_sender(load_bot):
+    bot = load_bot("a")
+    limiter = bot.RateLimiter(rate=1000, per_chat_interval=0)
+
+    async def scenario():
+        await limiter.acquire(1)
+        limiter.pause(0.2)
+        started = time.monotonic()
+        # Другие чаты и другие воркеры ждут конца паузы, хотя 429 получил не их запрос
+        await asyncio.gather(limiter.acquire(2), limiter.acquire(3))
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) >= 0.2
+
+
+def test_pause_does_not_leave_a_burst_behind(load_bot):
+    bot = load_bot("a")
+    limiter = bot.RateLimiter(rate=20, per_chat_interval=0)
+
+    async def scenario():
+        limiter.pause(0.05)
+        started = time.monotonic()
+        for chat_id in range(5):
+            await limiter.acquire(chat_id)
+        return time.monotonic() - started
+
+    # Пять токенов при 20 в секунду набираются не быстрее чем за ~0.25 с после паузы
+    assert asyncio.run(scenario()) >= 0.25
+
+
+def test_cluster_workers_share_the_send_rate(load_bot):
+    bot = load_bot("a")
+    bot.CLUSTER_DB = os.path.abspath("cluster.db")
+    bot.open_sent_store(bot.CLUSTER_DB)
+    bot.open_cluster()
+    for worker in ("b", "c"):
+        bot.sent_db.execute("INSERT INTO workers (id, heartbeat) VALUES (?, ?)", (worker, time.time()))
+    asyncio.run(bot.cluster_heartbeat())
+    assert bot.rate_limiter.rate == bot.SEND_RATE / 3
+
+    bot.sent_db.execute("DELETE FROM workers WHERE id != ?", ("a",))
+    asyncio.run(bot.cluster_heartbeat())
+    assert bot.rate_limiter.rate == bot.SEND_RATE
@@ -0,0 +1,44 @@
+import asyncio
+import json
+import os
+
+ROSTER = {
+    "alice": {"schedule": [{"day": "Понедельник", "time": "10:00", "description": ""}]},
+    "bob": {"schedule": [{"day": "Вторник", "time": "10:00", "description": ""}]},
+    "_journal": {"seq": 0},
+}
+
+
+def edit_by_hand(user_name, lesson, stamp):
+    with open("users.json", encoding="utf-8") as f:
+        data = json.load(f)
+    data[user_name]["schedule"] = [lesson]
+    with open("users.json", "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    # mtime должен отличаться, даже если обе правки попали в один квант часов ФС
+    os.utime("users.json", ns=(stamp, stamp))
+
+
+def test_repeated_hand_edits_survive_restart(load_bot):
+    first = {"day": "Среда", "time": "11:00", "description": ""}
+    second = {"day": "Четверг", "time": "12:00", "description": ""}
+
+    async def scenario():
+        bot = load_bot("a", roster=ROSTER)
+        bot.load_default_schedule()
+        base = os.stat("users.json").st_mtime_ns
+        edit_by_hand("alice", first, base + 10**9)
+        await bot.watch_schedule_file()
+        edit_by_hand("alice", second, base + 2 * 10**9)
+        await bot.watch_schedule_file()
+        assert bot.temporary_schedule["alice"]["schedule"] == [second]
+        # Повторная проверка без новых правок ничего не меняет
+        await bot.watch_schedule_file()
+        assert bot.temporary_schedule["alice"]["schedule"] == [second]
+
+    asyncio.run(scenario())
+
+    restarted = load_bot("b")
+    restarted.load_default_schedule()
+    assert restarted.temporary_schedule["alice"]["schedule"] == [second]
+    assert restarted.temporary_schedule["bob"] == ROSTER["bob"]
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+SECRET = "s3cr3t"
+
+
+class FakeApp:
+    running = True
+    bot = None
+    bot_data = {}
+
+    def __init__(self):
+        self.update_queue = asyncio.Queue()
+
+
+@pytest.mark.parametrize("body", [b"{}", b"[]", b'"text"', b"42", b"null", b"{not json", b'{"message": "x"}'])
+def test_malformed_updates_are_rejected(load_bot, body):
+    bot = load_bot("a")
+    app = FakeApp()
+    receive = bot.webhook_routes(app, SECRET)[("POST", bot.WEBHOOK_PATH)]
+    status, _, _ = asyncio.run(receive(body, {"x-telegram-bot-api-secret-token": SECRET}))
+    assert status == 400
+    assert app.update_queue.empty()
+
+
+def test_valid_update_is_queued(load_bot):
+    bot = load_bot("a")
+    app = FakeApp()
+    receive = bot.webhook_routes(app, SECRET)[("POST", bot.WEBHOOK_PATH)]
+    assert asyncio.run(receive(b'{"update_id": 1}', {"x-telegram-bot-api-secret-token": SECRET}))[0] == 200
+    assert app.update_queue.get_nowait().update_id == 1
+
+
+def test_wrong_secret_is_rejected(load_bot):
+    bot = load_bot("a")
+    receive = bot.webhook_routes(FakeApp(), SECRET)[("POST", bot.WEBHOOK_PATH)]
+    assert asyncio.run(receive(b'{"update_id": 1}', {"x-telegram-bot-api-secret-token": "nope"}))[0] == 401
+
+
+@pytest.mark.parametrize("request_bytes, status", [
+    (b"POST /x HTTP/1.1\r\nContent-Length: abc\r\n\r\n", b"400"),
+    (b"POST /x HTTP/1.1\r\nContent-Length: 99999999\r\n\r\n", b"413"),
+    (b"POST /x HTTP/1.1\r\nContent-Length: 2\r\n\r\nok", b"200"),
+])
+def test_http_server_answers_every_request(load_bot, request_bytes, status):
+    bot = load_bot("a")
+
+    async def ok(body, headers):
+        return 200, "text/plain", body
+
+    async def scenario():
+        server = await bot.serve_http("127.0.0.1", 0, {("POST", "/x"): ok})
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(request_bytes)
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        server.close()
+        return response
+
+    assert asyncio.run(scenario()).split()[1] == status